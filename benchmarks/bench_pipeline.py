@@ -0,0 +1,142 @@
+"""
+Times the stages of the PhAI pipeline one by one, headless.
+
+    python benchmarks/bench_pipeline.py [--hkl FILE] [--cell a b c al be ga]
+        [--space-group SYMBOL] [--cycles 5] [--repeat 3]
+        [--fft-grid adaptive] [--resolution-factor 0.333] [--use-symmetry]
+        [--peak-engine numpy] [--save NAME] [--compare NAME]
+
+By default the COD_2016452.hkl test file bundled with ai_for_olex.PhAI is
+used. The crystal symmetry is read from a .ins/.res/.cif next to the HKL file
+unless it is given on the command line. Every run goes through
+phai_headless.solve, i.e. the pipeline functions the plugin uses with the
+map options given here, and is timed with the stages of its Trace. Olex2 is
+replaced by the stand-ins in olex_standin.py, so atom posting measures the
+plugin side only.
+
+--save writes the median time of every stage to baselines/NAME.json, and
+--compare prints the current numbers against such a baseline.
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), "plugin-phai_for_olex"))
+sys.path.insert(0, HERE)
+
+import olex_standin
+
+olx = olex_standin.install()
+
+import PhAI_for_olex2 as pipeline
+import phai_headless
+from phai_hkl import default_hkl
+from phai_session import get_session
+from phai_trace import Trace
+
+BASELINE_DIR = os.path.join(HERE, "baselines")
+
+
+def crystal_symmetry(args):
+    cs = phai_headless.find_symmetry(args.hkl, args.cell, args.space_group)
+    if cs is None:
+        sys.exit("No crystal symmetry found for %s, use --cell/--space-group" % args.hkl)
+    return cs
+
+
+def run_once(times, args, cs):
+    """
+    Runs the pipeline once and adds the wall time of every stage to `times`
+    """
+    trace = Trace(os.path.basename(args.hkl))
+    peaks = phai_headless.solve(
+        args.hkl,
+        cs,
+        args.cycles,
+        "auto",
+        seed=0,
+        trace=trace,
+        fft_grid=args.fft_grid,
+        resolution_factor=args.resolution_factor,
+        use_symmetry=args.use_symmetry,
+        peak_engine=args.peak_engine,
+    )
+    with trace.stage("atom posting"):
+        pipeline.post_peaks(peaks.sites(), peaks.heights())
+    run = {}
+    for stage in trace.stages:
+        run[stage["stage"]] = run.get(stage["stage"], 0.0) + stage["wall_s"]
+    for stage, t in run.items():
+        times.setdefault(stage, []).append(t)
+
+
+def compare(current, name):
+    with open(os.path.join(BASELINE_DIR, name + ".json")) as f:
+        baseline = json.load(f)["stages"]
+    print("\n%-18s %10s %10s %8s" % ("stage", "baseline", "current", "ratio"))
+    for stage, t in current.items():
+        if stage in baseline:
+            # stages are timed to 0.1 ms, a baseline may be 0
+            ratio = "%.2f" % (t / baseline[stage]) if baseline[stage] else "-"
+            print("%-18s %10.4f %10.4f %8s" % (stage, baseline[stage], t, ratio))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--hkl")
+    parser.add_argument("--cell", type=float, nargs=6)
+    parser.add_argument("--space-group")
+    parser.add_argument("--cycles", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--fft-grid", choices=("fixed", "adaptive"), default="fixed")
+    parser.add_argument("--resolution-factor", type=float, default=1.0 / 3)
+    parser.add_argument("--use-symmetry", action="store_true")
+    parser.add_argument("--peak-engine", choices=("cctbx", "numpy"), default="cctbx")
+    parser.add_argument("--save", metavar="NAME")
+    parser.add_argument("--compare", metavar="NAME")
+    args = parser.parse_args(argv)
+    args.hkl = args.hkl or default_hkl()
+    cs = crystal_symmetry(args)
+
+    if pipeline.import_heavy_modules() is None:
+        sys.exit("The PhAI model could not be loaded, install torch and einops")
+    times = {"model load": [get_session().load_time]}
+    for i in range(args.repeat):
+        run_once(times, args, cs)
+
+    medians = dict((stage, statistics.median(t)) for stage, t in times.items())
+    print("%-18s %10s %10s" % ("stage", "median/s", "min/s"))
+    for stage, t in times.items():
+        print("%-18s %10.4f %10.4f" % (stage, medians[stage], min(t)))
+    print("olx calls: %s" % dict(olx.calls))
+
+    if args.save:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        with open(os.path.join(BASELINE_DIR, args.save + ".json"), "w") as f:
+            json.dump(
+                {
+                    "hkl": os.path.basename(args.hkl),
+                    "cycles": args.cycles,
+                    "repeat": args.repeat,
+                    "fft_grid": args.fft_grid,
+                    "resolution_factor": args.resolution_factor,
+                    "use_symmetry": args.use_symmetry,
+                    "peak_engine": args.peak_engine,
+                    "python": platform.python_version(),
+                    "machine": platform.machine(),
+                    "stages": medians,
+                },
+                f,
+                indent=2,
+            )
+    if args.compare:
+        compare(medians, args.compare)
+
+
+if __name__ == "__main__":
+    main()
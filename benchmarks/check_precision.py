@@ -0,0 +1,92 @@
+"""
+Compares the phases of the reduced precision CPU modes against fp32.
+
+    python benchmarks/check_precision.py [--hkl FILE] [--cycles 5]
+        [--seed 1] [--threads 0]
+
+Every mode phases the same reflections from the same seeded random start.
+For each mode the run time and the deviation from the fp32 phases are
+printed: the mean and 95th percentile of the absolute phase difference,
+weighted by |F| as well as unweighted, and the fraction of reflections
+within 30 degrees. By default the COD_2016452.hkl test file bundled with
+ai_for_olex.PhAI is used.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), "plugin-phai_for_olex"))
+
+import numpy as np
+
+from phai_hkl import default_hkl, read_hkl
+from phai_session import PRECISIONS, PhAISession
+
+
+def run(precision, args, hkl, f):
+    session = PhAISession()
+    session.configure(precision, args.threads)
+    session.load()
+    session.seed(args.seed)
+    t0 = time.perf_counter()
+    hkl_array, amplitudes_ord, ph = session.get_phases(
+        [f, hkl.astype(int)],
+        t=False,
+        randomize_phases=1,
+        cycles=args.cycles,
+        INPUT_IS_SQUARED=True,
+        name_infile=args.hkl,
+    )
+    seconds = time.perf_counter() - t0
+    session.unload()
+    return seconds, np.asarray(amplitudes_ord, dtype=np.float64), np.asarray(
+        ph, dtype=np.float64
+    ).ravel()
+
+
+def phase_error(ph, reference, weights):
+    diff = np.abs((ph - reference + 180.0) % 360.0 - 180.0)
+    return {
+        "mean": diff.mean(),
+        "weighted": (diff * weights).sum() / weights.sum(),
+        "p95": np.percentile(diff, 95),
+        "within_30": (diff <= 30.0).mean(),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--hkl")
+    parser.add_argument("--cycles", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--threads", type=int, default=0)
+    args = parser.parse_args(argv)
+    args.hkl = args.hkl or default_hkl()
+    hkl, f, sigma = read_hkl(args.hkl)
+
+    seconds, amplitudes, reference = run("fp32", args, hkl, f)
+    if amplitudes.shape != reference.shape:
+        amplitudes = np.ones_like(reference)
+    print(
+        "%-6s %8s %10s %10s %10s %10s"
+        % ("mode", "time/s", "mean/deg", "|F|w/deg", "p95/deg", "<=30 deg")
+    )
+    print("%-6s %8.3f %10s %10s %10s %10s" % ("fp32", seconds, "-", "-", "-", "-"))
+    for precision in PRECISIONS[1:]:
+        seconds, a, ph = run(precision, args, hkl, f)
+        if ph.shape != reference.shape:
+            print("%-6s %8.3f  phases do not match fp32 in shape" % (precision, seconds))
+            continue
+        e = phase_error(ph, reference, amplitudes)
+        print(
+            "%-6s %8.3f %10.2f %10.2f %10.2f %9.1f%%"
+            % (precision, seconds, e["mean"], e["weighted"], e["p95"],
+               100 * e["within_30"])
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Minimal stand-ins for the Olex2 modules used by the plugin (olx, olex,
+olexex, olexFunctions, cctbx_olex_adapter), so the pipeline in
+PhAI_for_olex2 can be imported and timed on a plain Linux box without Olex2.
+
+Every olx call is counted in `olx.calls`; olx.xf.au.NewAtom hands out
+increasing atom ids.
+"""
+
+import collections
+import sys
+import tempfile
+import types
+
+
+class Stub(types.ModuleType):
+    """
+    Module whose unknown attributes are functions that count their calls
+    and return an empty string, like most olx functions do
+    """
+
+    def __init__(self, name, calls):
+        super(Stub, self).__init__(name)
+        self.calls = calls
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+
+        def call(*args, **kwargs):
+            self.calls[self.__name__ + "." + name] += 1
+            return ""
+
+        return call
+
+
+class StandInOV(object):
+    def __init__(self):
+        self.params = {}
+        self.data_dir = tempfile.mkdtemp(prefix="phai_bench_")
+
+    def HasGUI(self):
+        return False
+
+    def GetParam(self, name, default=None):
+        return self.params.get(name, default)
+
+    def SetParam(self, name, value):
+        self.params[name] = value
+
+    def DataDir(self):
+        return self.data_dir
+
+    def registerFunction(self, *args, **kwargs):
+        pass
+
+
+class StandInCctbxAdapter(object):
+    def __init__(self, *args, **kwargs):
+        raise RuntimeError("the benchmark builds f_sq_obs itself")
+
+
+def install():
+    """
+    Puts the stand-ins into sys.modules and returns the olx stand-in
+    """
+    calls = collections.Counter()
+    olx = Stub("olx", calls)
+    olx.xf = Stub("olx.xf", calls)
+    olx.xf.au = Stub("olx.xf.au", calls)
+    olx.gl = Stub("olx.gl", calls)
+    olx.html = Stub("olx.html", calls)
+
+    next_id = iter(range(1, 1 << 30))
+
+    def new_atom(name, *xyz):
+        calls["olx.xf.au.NewAtom"] += 1
+        return str(next(next_id))
+
+    olx.xf.au.NewAtom = new_atom
+
+    olex_functions = types.ModuleType("olexFunctions")
+    olex_functions.OV = StandInOV()
+    olex_functions.OlexFunctions = lambda: olex_functions.OV
+    adapter = types.ModuleType("cctbx_olex_adapter")
+    adapter.OlexCctbxAdapter = StandInCctbxAdapter
+
+    sys.modules["olx"] = olx
+    sys.modules["olex"] = Stub("olex", calls)
+    sys.modules["olexex"] = Stub("olexex", calls)
+    sys.modules["olexFunctions"] = olex_functions
+    sys.modules["cctbx_olex_adapter"] = adapter
+    return olx
@@ -1,6 +1,6 @@
-import numpy as np
 import os
 import sys, getopt
+import time
 
 print(os.getcwd())
 
@@ -8,19 +8,35 @@ print(os.getcwd())
 # ===========================
 
 try:
-    # """
-    from cctbx import maptbx
-    from cctbx import miller
-    from cctbx.array_family import flex
-    from cctbx import sgtbx
-    from cctbx_olex_adapter import OlexCctbxAdapter
     from olexFunctions import OV
     import olexex
     import olx
-    from NoSpherA2 import cubes_maps
 
-    # """
-    # '''
+    DRY_RUN = False
+except:
+    print(
+        "No olex functionalities could be loaded, you are potentially operating outside of olex2."
+    )
+    print("This script will be run in form of a dry run. Setting DRY_RUN to True.")
+    DRY_RUN = True
+
+# ===========================
+
+from phai_session import get_session
+from phai_hkl import default_hkl, read_hkl
+from phai_worker import PhasingJob
+from phai_trace import Trace
+import phai_pipeline
+from phai_pipeline import phase_reflections, map_peaks, MAP_OPTIONS
+from phai_pipeline import compute_solution_peaks
+
+# cctbx, torch and einops are only imported on the first call to
+# create_solution_map, so that loading the plugin stays instant
+OlexCctbxAdapter = None
+deferred_import_time = None
+
+
+def check_torch():
     # check if we have torch and einops installed
     try:
         import torch
@@ -45,30 +61,47 @@ try:
             print(
                 "Please install torch and einops inside the DataDir() manually, keeping in mind the version compatibility with installed numpy, scipy and pillow!"
             )
-    DRY_RUN = False
-    # '''
-except:
-    print(
-        "No olex functionalities could be loaded, you are potentially operating outside of olex2."
-    )
-    print("This script will be run in form of a dry run. Setting DRY_RUN to True.")
-    DRY_RUN = True
-
-# ===========================
+            return False
+    return True
+
+
+def import_heavy_modules(load_model=True):
+    """
+    Imports cctbx, torch/einops and the PhAI model on first use and reports
+    how long that took. Later calls return immediately. Without
+    `load_model` (phasing by the daemon) torch is left alone; it is still
+    loaded on demand if the daemon cannot be reached.
+    """
+    global OlexCctbxAdapter, deferred_import_time
+    if deferred_import_time is not None:
+        return deferred_import_time
+    t0 = time.perf_counter()
+    phai_pipeline.import_cctbx()
+    from cctbx_olex_adapter import OlexCctbxAdapter
 
-from ai_for_olex.PhAI import get_PhAI_phases
+    if load_model:
+        if not check_torch():
+            return None
+        get_session().load()
+    deferred_import_time = time.perf_counter() - t0
+    print("PhAI: deferred imports took %.2f s" % deferred_import_time)
+    return deferred_import_time
 
 # ===============================================================
 
 if DRY_RUN:
 
     def main(argv):
-        args = "-i -n -t -p".split()
-        optlist, args = getopt.getopt(argv, "i:n:tp:")
+        args = "-i -n -t -p -b -w -j -o".split()
+        optlist, args = getopt.getopt(argv, "i:n:tp:b:w:j:o:")
         infile = ""
         n = 1
         t = False
         p = 0
+        batch = ""
+        workers = 1
+        threads = 0
+        out_dir = ""
         for opt, arg in optlist:
             if opt == "-i":
                 infile = arg
@@ -78,166 +111,266 @@ if DRY_RUN:
                 t = True
             elif opt == "-p":
                 p = int(arg)
+            elif opt == "-b":
+                batch = arg
+            elif opt == "-w":
+                workers = int(arg)
+            elif opt == "-j":
+                threads = int(arg)
+            elif opt == "-o":
+                out_dir = arg
+
+        return infile, n, t, p, batch, workers, threads, out_dir
+
+    def dry_run(infile, n, t, p):
+        if not infile and DRY_RUN:
+            infile = default_hkl()
+
+            n = 5
+            p = 1
+            t = True  ## this must be the saving parameter
+
+        cycles = n
+
+        dict_params_PhAI = {}
+        dict_params_PhAI["t"] = t
+        dict_params_PhAI["randomize_phases"] = p
+        dict_params_PhAI["cycles"] = cycles
+        dict_params_PhAI["INPUT_IS_SQUARED"] = True
+        dict_params_PhAI["name_infile"] = os.path.join(
+            os.getcwd(), os.path.basename(infile)
+        )
 
-        return infile, n, t, p
-
-    infile, n, t, p = main(sys.argv[1:])
-    if not infile and DRY_RUN:
-        import importlib.resources
-
-        # Get a Traversable object for the 'test_files' package directory
-        path_testing_dir = importlib.resources.files("ai_for_olex.PhAI.test_files")
-
-        infile = path_testing_dir / "COD_2016452.hkl"
-        infile = str(infile)
-
-        n = 5
-        p = 1
-        t = True  ## this must be the saving parameter
-
-    cycles = n
-
-    dict_params_PhAI = {}
-    dict_params_PhAI["t"] = t
-    dict_params_PhAI["randomize_phases"] = p
-    dict_params_PhAI["cycles"] = cycles
-    dict_params_PhAI["INPUT_IS_SQUARED"] = True
-    dict_params_PhAI["name_infile"] = os.path.join(
-        os.getcwd(), os.path.basename(infile)
-    )
-
-    # =================================================================================
-
-    ### I adapt how the file is read here, since an olex2 (shelx?) input file must have 5 five columns
-    data = np.loadtxt(infile)  # , delimiter=" ")
-    H_tmp = data[:, 0:3].astype(int)
-    Fabs_tmp = data[:, 3].astype(float)
-    f_sq_obs = [Fabs_tmp, H_tmp]
-    # guess = get_PhAI_phases(
-    #     f_sq_obs, randomize_phases=1, cycles=int(cycles), name_infile=infile
-    # )
-    guess = get_PhAI_phases(f_sq_obs, **dict_params_PhAI)
+        # =================================================================================
+
+        ### I adapt how the file is read here, since an olex2 (shelx?) input file must have 5 five columns
+        # parsed reflections are cached next to the HKL file, see phai_hkl
+        hkl, f, sigma = read_hkl(infile)
+        H_tmp = hkl.astype(int)
+        Fabs_tmp = f
+        f_sq_obs = [Fabs_tmp, H_tmp]
+        # guess = get_PhAI_phases(
+        #     f_sq_obs, randomize_phases=1, cycles=int(cycles), name_infile=infile
+        # )
+        guess = get_session().get_phases(f_sq_obs, **dict_params_PhAI)
+        return guess
+
+    # worker processes of the batch mode import this module again, so only
+    # the script itself may run anything
+    if __name__ == "__main__":
+        infile, n, t, p, batch, workers, threads, out_dir = main(sys.argv[1:])
+        if batch:
+            from phai_batch import run_batch
+
+            run_batch(
+                batch,
+                out_dir or os.getcwd(),
+                cycles=n,
+                randomize_phases=p,
+                workers=workers,
+                threads=threads,
+            )
+        else:
+            dry_run(infile, n, t, p)
 
 
 if not DRY_RUN:
 
-    def millering(f_sq_obs, hkl_array, amplitudes_ord, ph):
-        # try:
-        # multiply Fs with the phases:
-        C_Fs = flex.complex_double(
-            (amplitudes_ord * np.exp(1j * np.deg2rad(ph))).tolist()
-        )
-        # for c_number in list(C_Fs):
-        #     print(c_number)
-        miller_set = miller.array(
-            miller_set=miller.set(
-                crystal_symmetry=f_sq_obs.crystal_symmetry(),
-                indices=flex.miller_index(hkl_array.tolist()),
-                anomalous_flag=False,
-            ),
-            data=C_Fs,
-        )
-        # print(miller_set)
-        return miller_set
-
-    # except Exception as e:
-    #     print("something wrong with 'millering'?")
-    #     print(e)
-    #     pass
-
-    def post_single_peak(xyz, height, cutoff=1.0):
-        sp = height  # hp
-        id = olx.xf.au.NewAtom("%.2f" % (sp), *xyz)
-        if id != "-1":
-            olx.xf.au.SetAtomU(id, "0.06")
-
-    def create_solution_map(cycles=1, max_peaks="auto"):
-        cctbx_adapter = OlexCctbxAdapter()
-        f_sq_obs = cctbx_adapter.reflections.f_sq_obs_merged
-        # print(f_sq_obs)
-        hkl_array, amplitudes_ord, ph = get_PhAI_phases(
-            f_sq_obs,
-            randomize_phases=1,
-            cycles=int(cycles),
-            name_infile="",
-            INPUT_IS_SQUARED=True,
-        )
-        guess = millering(f_sq_obs, hkl_array, amplitudes_ord, ph)
-        # print(guess)
-        print("test1")
-        # rename it  fft_map_?
-        guess = guess.expand_to_p1().set_observation_type_xray_amplitude()
-
-        if max_peaks == "auto":
-            expected_peaks = (
-                guess.unit_cell().volume() / 18.6 / len(guess.space_group())
-            )
-            expected_peaks *= 1.3
-            max_peaks = expected_peaks
-        max_peaks = int(max_peaks)
-        print("test2")
-
-        obs_map = guess.fft_map(
-            symmetry_flags=sgtbx.search_symmetry_flags(use_space_group_symmetry=False),
-            resolution_factor=1,
-            grid_step=0.2,
-            f_000=1200,
-        ).apply_volume_scaling()
-        obs_map.apply_volume_scaling()
-        # print("obs_map")
-        # print(obs_map)
-        # print(guess.d_min())
-        # print()
-        peaks = obs_map.peak_search(
-            parameters=maptbx.peak_search_parameters(
-                # peak_search_level=1,
-                # peak_cutoff=0.05,
-                # interpolate=True,
-                min_distance_sym_equiv=0.2,
-                general_positions_only=False,
-                min_cross_distance=guess.d_min() / 2,
-                max_clusters=max_peaks,
-            ),
-            verify_symmetry=True,
-        ).all()
-        print("test3")
-
-        # print('peaks')
-        # print(list(peaks))
-        # for xyz, height in zip(peaks.sites(), peaks.heights()):
-        #     print(xyz, height)
-
-        olx.Kill("$Q", au=True)
-
-        print('\n\n\n\nhallo\n\n\n\n')
-
-        for xyz, height in zip(peaks.sites(), peaks.heights()):
-            # print("xyz, height", xyz, height)
-            if not xyz:
-                have_solution = False
-                break
-            else:
-                post_single_peak(xyz, height)
-        if OV.HasGUI():
-            try:
-                olx.Freeze(True)
-                olx.Compaq(q=True)
-                olx.xf.EndUpdate()
-                olx.Move()
-            finally:
-                olx.Freeze(False)
-
+    def post_peaks(sites, heights):
+        """
+        Replaces the Q-peaks with `sites` in one batch: the GUI stays frozen
+        while the atoms are added and the model is updated only once at the
+        end. Returns the number of peaks posted.
+        """
+        new_atom = olx.xf.au.NewAtom
+        set_atom_u = olx.xf.au.SetAtomU
         if OV.HasGUI():
             basis = olx.gl.Basis()
             frozen = olx.Freeze(True)
-        olx.xf.EndUpdate(True)  # clear LST
-        olx.Compaq(q=True)
+        posted = 0
+        try:
+            olx.Kill("$Q", au=True)
+            for xyz, height in zip(sites, heights):
+                if not xyz:
+                    break
+                id = new_atom("%.2f" % height, *xyz)
+                if id != "-1":
+                    set_atom_u(id, "0.06")
+                    posted += 1
+            olx.xf.EndUpdate(True)  # clear LST
+            olx.Compaq(q=True)
+            if OV.HasGUI():
+                olx.Move()
+        finally:
+            if OV.HasGUI():
+                olx.gl.Basis(basis)
+                olx.Freeze(frozen)
+        return posted
+
+    # the Trace of the last completed run
+    last_trace = None
+
+    def finish_trace(trace, trace_log=""):
+        global last_trace
+        last_trace = trace
+        print(trace.summary())
+        if trace_log:
+            try:
+                trace.append_jsonl(trace_log)
+            except OSError as e:
+                print("Could not write the PhAI trace to %s: %s" % (trace_log, e))
+
+    def get_timings():
+        if last_trace is None:
+            return ""
+        return last_trace.summary()
+
+    def loaded_structure():
+        """
+        Returns the file name and unit cell of the structure loaded in Olex2
+        """
+        return OV.FileName(), str(olx.xf.au.GetCell())
+
+    def merged_reflections(trace):
+        with trace.stage("reflection merging"):
+            cctbx_adapter = OlexCctbxAdapter()
+            return cctbx_adapter.reflections.f_sq_obs_merged
+
+    def job_running():
+        """
+        True (with a message) while a PhasingJob uses the model; nothing
+        else may phase or unload it then
+        """
+        if current_job is None:
+            return False
+        print("PhAI is already running, wait for it or cancel it.")
+        return True
+
+    def create_solution_map(
+        cycles=1, max_peaks="auto", trace_log="", **settings
+    ):
+        if job_running():
+            return None
+        if import_heavy_modules(not settings.get("daemon_port")) is None:
+            return
+        trace = Trace(OV.FileName())
+        f_sq_obs = merged_reflections(trace)
+        # print(f_sq_obs)
+        peaks = compute_solution_peaks(
+            f_sq_obs, cycles, max_peaks, trace=trace, **settings
+        )
+        with trace.stage("atom posting"):
+            posted = post_peaks(peaks.sites(), peaks.heights())
+        print("PhAI: posted %i peaks" % posted)
+        finish_trace(trace, trace_log)
+        return posted
+
+    def create_candidate_maps(
+        cycles=1, max_peaks="auto", candidates=2, trace_log="", **settings
+    ):
+        """
+        Phases the current structure with `candidates` random starts and
+        returns the peaks of every map, without posting any of them. The
+        peaks are those of the asymmetric unit, as the candidate .ins files
+        carry the symmetry of the structure.
+        """
+        if job_running():
+            return None
+        if import_heavy_modules(not settings.get("daemon_port")) is None:
+            return None
+        trace = Trace(OV.FileName())
+        f_sq_obs = merged_reflections(trace)
+        map_options = dict((k, settings.pop(k)) for k in MAP_OPTIONS if k in settings)
+        map_options["use_symmetry"] = True
+        with trace.stage("inference"):
+            phase_sets = phase_reflections(f_sq_obs, cycles, candidates, **settings)
+        peak_sets = [
+            map_peaks(f_sq_obs, phase_set, max_peaks, trace=trace, **map_options)
+            for phase_set in phase_sets
+        ]
+        finish_trace(trace, trace_log)
+        return peak_sets
+
+    # the PhasingJob started by start_solution_map, until poll_job collects it
+    current_job = None
+
+    def show_progress(message):
         if OV.HasGUI():
-            olx.gl.Basis(basis)
-            olx.Freeze(frozen)
-        olx.Compaq(q=True)
-
-
+            olx.html.SetValue("PHAI_PROGRESS", message)
+
+    def start_solution_map(
+        cycles=1, max_peaks="auto", on_done=None, trace_log="", **settings
+    ):
+        """
+        Like create_solution_map, but phasing, FFT and peak search run in a
+        PhasingJob. poll_job posts the peaks on the main thread and then
+        calls `on_done()`.
+        """
+        global current_job
+        if job_running():
+            return None
+        if import_heavy_modules(not settings.get("daemon_port")) is None:
+            return None
+        trace = Trace(OV.FileName())
+        f_sq_obs = merged_reflections(trace)
+        current_job = PhasingJob(
+            compute_solution_peaks,
+            f_sq_obs,
+            cycles,
+            max_peaks,
+            trace=trace,
+            **settings
+        )
+        current_job.on_done = on_done
+        # the structure the peaks belong to, checked before they are posted
+        current_job.structure = loaded_structure()
+        current_job.trace = trace
+        current_job.trace_log = trace_log
+        current_job.start()
+        olx.Schedule(1, "spy.phai_new.poll_job()")
+        return current_job
+
+    def poll_job():
+        global current_job
+        job = current_job
+        if job is None:
+            return
+        if job.is_alive():
+            show_progress("%s (%.0f s)" % (job.progress, job.elapsed))
+            olx.Schedule(1, "spy.phai_new.poll_job()")
+            return
+        current_job = None
+        if job.cancelled:
+            show_progress("cancelled")
+            print("PhAI: run cancelled after %.1f s" % job.elapsed)
+            return
+        if job.error is not None:
+            show_progress("failed")
+            print("PhAI: run failed\n%s" % job.error)
+            return
+        if loaded_structure() != job.structure:
+            show_progress("dropped")
+            print(
+                "PhAI: %s is no longer loaded, the peaks of the run are dropped"
+                % job.structure[0]
+            )
+            return
+        with job.trace.stage("atom posting"):
+            posted = post_peaks(job.result.sites(), job.result.heights())
+        show_progress("done, %i peaks in %.0f s" % (posted, job.elapsed))
+        print("PhAI: posted %i peaks" % posted)
+        finish_trace(job.trace, job.trace_log)
+        if job.on_done is not None:
+            job.on_done()
+
+    def cancel_job():
+        if current_job is None:
+            return False
+        # inference that does not report its cycles runs to its end, the
+        # result is dropped
+        current_job.cancel()
+        show_progress("cancelling...")
+        return True
 
     # OV.registerFunction(
     #     create_solution_map,
@@ -0,0 +1,139 @@
+"""
+Batch mode of the PhAI dry run: phases every HKL file of a directory or glob
+in a pool of worker processes.
+
+    python PhAI_for_olex2.py -b "cod/*.hkl" -n 5 -p 1 -w 8 -j 2 -o results
+
+-w sets the number of worker processes and -j the torch threads per worker.
+The phases of each file are written to <out_dir>/<name>_phai.npz, <name>
+being its path relative to the common directory of all files with the
+separators replaced by "__". The input directories are left untouched. One
+line per file is added to <out_dir>/phai_batch_summary.tsv as soon as it is
+finished. Files already listed there as ok (with their output present) are
+skipped, so an interrupted run continues where it stopped.
+"""
+
+import concurrent.futures
+import glob
+import os
+import time
+
+import numpy as np
+
+from phai_hkl import read_hkl
+from phai_session import get_session
+
+SUMMARY_NAME = "phai_batch_summary.tsv"
+SUMMARY_COLUMNS = ("file", "status", "reflections", "seconds", "output")
+
+
+def collect_files(pattern):
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, "*.hkl")
+    return sorted(os.path.abspath(f) for f in glob.glob(pattern))
+
+
+def output_names(files):
+    """
+    Returns a unique output name for each of the absolute paths `files`
+    """
+    if len(files) == 1:
+        root = os.path.dirname(files[0])
+    else:
+        root = os.path.commonpath(files)
+    names = []
+    for path in files:
+        name = os.path.splitext(os.path.relpath(path, root))[0]
+        names.append(name.replace(os.sep, "__"))
+    return names
+
+
+def read_summary(path):
+    done = {}
+    if not os.path.exists(path):
+        return done
+    with open(path) as f:
+        for line in f.readlines()[1:]:
+            row = dict(zip(SUMMARY_COLUMNS, line.rstrip("\n").split("\t")))
+            if row.get("status") == "ok" and os.path.exists(row.get("output", "")):
+                done[row["file"]] = row
+    return done
+
+
+def init_worker(threads):
+    # has to happen before torch is imported in this process
+    if threads > 0:
+        for name in ("OMP_NUM_THREADS", "MKL_NUM_THREADS"):
+            os.environ[name] = str(threads)
+        import torch
+
+        torch.set_num_threads(threads)
+        try:
+            torch.set_num_interop_threads(1)
+        except RuntimeError:
+            pass
+
+
+def phase_file(infile, out_dir, name, cycles, randomize_phases):
+    t0 = time.perf_counter()
+    output = os.path.join(out_dir, name + "_phai.npz")
+    row = {"file": infile, "status": "ok", "reflections": 0, "output": output}
+    try:
+        # no parse cache, it would be written next to every input file
+        hkl, f, sigma = read_hkl(infile, use_cache=False)
+        row["reflections"] = len(f)
+        hkl_array, amplitudes_ord, ph = get_session().get_phases(
+            [f, hkl.astype(int)],
+            t=False,
+            randomize_phases=randomize_phases,
+            cycles=cycles,
+            INPUT_IS_SQUARED=True,
+            name_infile=infile,
+        )
+        np.savez(output, hkl=hkl_array, amplitudes=amplitudes_ord, ph=ph)
+    except Exception as e:
+        row["status"] = "error: %s" % str(e).replace("\t", " ").replace("\n", " ")
+        row["output"] = ""
+    row["seconds"] = "%.2f" % (time.perf_counter() - t0)
+    return row
+
+
+def run_batch(
+    pattern, out_dir, cycles=5, randomize_phases=1, workers=1, threads=0
+):
+    files = collect_files(pattern)
+    if not files:
+        print("No HKL files match %s" % pattern)
+        return []
+    os.makedirs(out_dir, exist_ok=True)
+    summary = os.path.join(out_dir, SUMMARY_NAME)
+    done = read_summary(summary)
+    names = dict(zip(files, output_names(files)))
+    todo = [f for f in files if f not in done]
+    print(
+        "PhAI batch: %i files, %i already done, %i worker(s)"
+        % (len(files), len(files) - len(todo), workers)
+    )
+
+    new_summary = not os.path.exists(summary)
+    rows = []
+    with open(summary, "a") as out, concurrent.futures.ProcessPoolExecutor(
+        max_workers=max(1, workers), initializer=init_worker, initargs=(threads,)
+    ) as pool:
+        if new_summary:
+            out.write("\t".join(SUMMARY_COLUMNS) + "\n")
+        jobs = [
+            pool.submit(phase_file, f, out_dir, names[f], cycles, randomize_phases)
+            for f in todo
+        ]
+        for i, job in enumerate(concurrent.futures.as_completed(jobs)):
+            row = job.result()
+            rows.append(row)
+            out.write("\t".join(str(row[c]) for c in SUMMARY_COLUMNS) + "\n")
+            out.flush()
+            print(
+                "[%i/%i] %s: %s (%s s)"
+                % (i + 1, len(todo), os.path.basename(row["file"]), row["status"],
+                   row["seconds"])
+            )
+    return rows
@@ -0,0 +1,109 @@
+"""
+On-disk cache of PhAI results.
+
+An entry holds the (hkl_array, amplitudes_ord, ph) sets of one run and is
+keyed on a hash of the merged reflections, the unit cell and space group, the
+number of cycles and starts, the random seed and the model version. The cache
+directory is kept below a size cap by removing the least recently used
+entries first.
+"""
+
+import hashlib
+import os
+
+import numpy as np
+
+
+def pack_phase_sets(phase_sets):
+    """
+    Returns the arrays the (hkl_array, amplitudes_ord, ph) sets are stored
+    as, in a cache entry or a phai_daemon reply
+    """
+    arrays = {}
+    for i, (hkl_array, amplitudes_ord, ph) in enumerate(phase_sets):
+        arrays["hkl_%i" % i] = np.asarray(hkl_array)
+        arrays["amplitudes_%i" % i] = np.asarray(amplitudes_ord)
+        arrays["ph_%i" % i] = np.asarray(ph)
+    return arrays
+
+
+def unpack_phase_sets(arrays):
+    """
+    The reverse of pack_phase_sets, `arrays` may be a dict or an open npz
+    file
+    """
+    return [
+        (arrays["hkl_%i" % i], arrays["amplitudes_%i" % i], arrays["ph_%i" % i])
+        for i in range(len(arrays) // 3)
+    ]
+
+
+class PhaseCache(object):
+    def __init__(self, directory, max_mb=256):
+        self.directory = directory
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(indices, data, unit_cell, space_group, **settings):
+        """
+        `indices` and `data` are the merged reflections as numpy arrays, the
+        remaining arguments anything else the result depends on.
+        """
+        h = hashlib.sha256()
+        h.update(np.ascontiguousarray(indices, dtype=np.int32).tobytes())
+        h.update(np.ascontiguousarray(data, dtype=np.float64).tobytes())
+        h.update((("%.4f " * 6) % tuple(unit_cell)).encode())
+        h.update(str(space_group).encode())
+        for name in sorted(settings):
+            h.update(("%s=%s;" % (name, settings[name])).encode())
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".npz")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with np.load(path) as npz:
+                sets = unpack_phase_sets(npz)
+        except (OSError, KeyError, ValueError):
+            return None
+        # the modification time doubles as the last access time for the LRU
+        os.utime(path)
+        return sets
+
+    def put(self, key, phase_sets):
+        arrays = pack_phase_sets(phase_sets)
+        path = self._path(key)
+        tmp = path + ".tmp"
+        try:
+            with open(tmp, "wb") as f:
+                np.savez(f, **arrays)
+            os.replace(tmp, path)
+        except OSError as e:
+            print("Could not write the PhAI cache entry %s: %s" % (path, e))
+            return
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".npz"):
+                continue
+            st = os.stat(os.path.join(self.directory, name))
+            entries.append((st.st_mtime, st.st_size, name))
+        total = sum(size for mtime, size, name in entries)
+        for mtime, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+                total -= size
+            except OSError:
+                pass
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if name.endswith(".npz"):
+                os.remove(os.path.join(self.directory, name))
@@ -0,0 +1,162 @@
+"""
+Parallel refinement of several PhAI candidate solutions.
+
+Every candidate map is written as its own .ins/.hkl pair (peaks as isotropic
+carbon atoms, instructions taken from the current structure) and refined by
+an external SHELXL-compatible program, each in its own process. The candidate
+with the lowest R1 is the one phai_new.solve loads.
+"""
+
+import concurrent.futures
+import os
+import re
+import shutil
+import subprocess
+
+from olexFunctions import OV
+
+R1_RE = re.compile(r"^REM\s+R1\s*=\s*([0-9.]+)", re.M)
+# SHELX atom names have at most 4 characters, C1..C999
+MAX_ATOMS = 999
+
+
+def _keyword(line):
+    words = line.split()
+    return words[0].upper() if words else ""
+
+
+def template_lines(path):
+    """
+    Returns the lines of the .ins/.res file `path` before the atoms (up to
+    and including FVAR) and its HKLF line
+    """
+    header = []
+    hklf = "HKLF 4\n"
+    in_atoms = False
+    with open(path) as f:
+        for line in f:
+            keyword = _keyword(line)
+            if keyword == "HKLF":
+                hklf = line
+                break
+            if keyword == "END":
+                break
+            if not in_atoms:
+                header.append(line)
+                in_atoms = keyword == "FVAR"
+    if not in_atoms:
+        header.append("FVAR 1.0\n")
+    return header, hklf
+
+
+def candidate_ins(header, hklf, sites, refine_cycles=4):
+    """
+    Returns the text of a .ins file with `sites` (fractional coordinates of
+    the asymmetric unit, strongest first) as isotropic carbon atoms, at
+    most MAX_ATOMS of them
+    """
+    sfac = []
+    last_sfac = None
+    for i, line in enumerate(header):
+        if _keyword(line) == "SFAC":
+            sfac += [e.capitalize() for e in line.split()[1:]]
+            last_sfac = i
+    add_carbon = "C" not in sfac
+
+    lines = []
+    for i, line in enumerate(header):
+        keyword = _keyword(line)
+        if keyword in ("L.S.", "LS", "CGLS"):
+            continue
+        if add_carbon and i == last_sfac:
+            line = line.rstrip("\n") + " C\n"
+        elif add_carbon and keyword == "UNIT":
+            line = line.rstrip("\n") + " 1\n"
+        elif keyword == "FVAR":
+            lines.append("L.S. %i\n" % refine_cycles)
+        lines.append(line)
+    if add_carbon:
+        sfac.append("C")
+    carbon = sfac.index("C") + 1
+    for i, xyz in enumerate(list(sites)[:MAX_ATOMS]):
+        lines.append(
+            "C%i %i %.5f %.5f %.5f 11.00000 0.05\n" % ((i + 1, carbon) + tuple(xyz))
+        )
+    lines.append(hklf)
+    lines.append("END\n")
+    return "".join(lines)
+
+
+def refine(program, ins_path):
+    """
+    Runs `program` on `ins_path` and returns the R1 of the resulting .res
+    file, or None if the refinement failed
+    """
+    directory, name = os.path.split(ins_path)
+    stem = os.path.splitext(name)[0]
+    res = os.path.join(directory, stem + ".res")
+    try:
+        if os.path.exists(res):
+            os.remove(res)
+        subprocess.run(
+            [program, stem],
+            cwd=directory,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            creationflags=getattr(subprocess, "CREATE_NO_WINDOW", 0),
+        )
+        with open(res) as f:
+            match = R1_RE.search(f.read())
+    except OSError:
+        return None
+    return float(match.group(1)) if match else None
+
+
+def candidate_path(index, ext=".res"):
+    """
+    Returns the path of the `ext` file of candidate `index` (counted from 0)
+    """
+    name = "candidate_%i%s" % (index + 1, ext)
+    return os.path.join(OV.StrDir(), "phai_candidates", name)
+
+
+def select_best_candidate(peak_sets, program="shelxl", refine_cycles=4, workers=0):
+    """
+    Refines every candidate in `peak_sets` in parallel and returns
+    (index, R1) of the best one, or (None, None) if none could be refined.
+    The refined model of candidate `index` is in candidate_path(index)
+    """
+    exe = shutil.which(program)
+    if exe is None:
+        print("PhAI: %s not found, cannot rank the candidates" % program)
+        return None, None
+    stem = os.path.splitext(OV.FileFull())[0]
+    templates = [stem + ext for ext in (".ins", ".res") if os.path.exists(stem + ext)]
+    if not templates:
+        print("PhAI: candidates need the .ins or .res file of the structure")
+        return None, None
+    header, hklf = template_lines(templates[0])
+
+    os.makedirs(os.path.dirname(candidate_path(0)), exist_ok=True)
+    paths = []
+    for i, peaks in enumerate(peak_sets):
+        stem = candidate_path(i, "")
+        with open(stem + ".ins", "w") as f:
+            f.write(candidate_ins(header, hklf, peaks.sites(), refine_cycles))
+        shutil.copyfile(OV.HKLSrc(), stem + ".hkl")
+        paths.append(stem + ".ins")
+
+    workers = workers or min(len(paths), os.cpu_count() or 1)
+    # the refinements are separate processes, the threads only wait for them
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        r1s = list(pool.map(lambda path: refine(exe, path), paths))
+
+    for i, r1 in enumerate(r1s):
+        print(
+            "PhAI candidate %i: R1 = %s" % (i + 1, "-" if r1 is None else "%.4f" % r1)
+        )
+    ranked = [(r1, i) for i, r1 in enumerate(r1s) if r1 is not None]
+    if not ranked:
+        return None, None
+    r1, best = min(ranked)
+    return best, r1
@@ -0,0 +1,390 @@
+"""
+Local PhAI phasing daemon.
+
+    python phai_daemon.py [--port 8765] [--precision fp32|bf16]
+        [--threads 0] [--interop-threads 0] [--version NAME]
+        [--token-file FILE]
+
+The daemon imports ai_for_olex.PhAI (and torch) once, keeps the model warm and
+phases reflections sent to it over a localhost TCP connection, so the Olex2
+process itself never imports torch, survives a crash in inference and several
+Olex2 sessions on one machine share one model. Requests are served one at a
+time.
+
+Every message is a frame: two big-endian uint32 lengths, a JSON header and an
+npz payload (loaded without pickle). A "phase" request carries the merged
+reflections (indices and data) and the phasing options in PHASE_OPTIONS; they
+are phased in the [F, H] form get_PhAI_phases takes, so the daemon does not
+need cctbx. The reply carries the phase sets as phai_cache.pack_phase_sets
+stores them.
+
+The port is opened at once and the model loaded in the background: "ping"
+answers with the state ("loading", "ready" or "failed") right away and
+"phase" requests wait for the load. Every request except "ping" has to carry
+the token the daemon writes to its token file (only readable by the user
+who started it), so other local users cannot use or stop it. The token is
+checked before the payload is read, and frames larger than MAX_HEADER and
+MAX_PAYLOAD are refused.
+"""
+
+import argparse
+import hmac
+import io
+import json
+import os
+import secrets
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+
+import numpy as np
+
+from phai_cache import pack_phase_sets, unpack_phase_sets
+
+DEFAULT_PORT = 8765
+FRAME = struct.Struct("!II")
+# frames with a larger header or payload are refused before they are read
+MAX_HEADER = 1 << 16
+MAX_PAYLOAD = 1 << 28
+# the options of a "phase" request and their types; nothing else is passed on
+PHASE_OPTIONS = {
+    "cycles": int,
+    "starts": int,
+    "seed": int,
+    "INPUT_IS_SQUARED": bool,
+}
+
+
+def default_token_file(port):
+    return os.path.join(os.path.expanduser("~"), ".phai_daemon_%i.token" % port)
+
+
+def write_token(path):
+    token = secrets.token_hex(16)
+    if os.path.exists(path):
+        os.remove(path)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "w") as f:
+        f.write(token)
+    return token
+
+
+def read_token(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return ""
+
+
+def _recv_exactly(sock, n):
+    chunks = []
+    while n:
+        chunk = sock.recv(min(n, 1 << 20))
+        if not chunk:
+            raise ConnectionError("PhAI daemon connection closed")
+        chunks.append(chunk)
+        n -= len(chunk)
+    return b"".join(chunks)
+
+
+def send_frame(sock, header, arrays=None):
+    payload = b""
+    if arrays:
+        buf = io.BytesIO()
+        np.savez(buf, **arrays)
+        payload = buf.getvalue()
+    header = json.dumps(header).encode()
+    sock.sendall(FRAME.pack(len(header), len(payload)) + header + payload)
+
+
+def recv_header(sock):
+    """
+    Reads the lengths and the header of a frame and returns the header and
+    the size of the payload that follows
+    """
+    header_size, payload_size = FRAME.unpack(_recv_exactly(sock, FRAME.size))
+    if header_size > MAX_HEADER or payload_size > MAX_PAYLOAD:
+        raise ValueError(
+            "frame of %i + %i bytes is too large" % (header_size, payload_size)
+        )
+    header = json.loads(_recv_exactly(sock, header_size).decode())
+    if not isinstance(header, dict):
+        raise ValueError("the header is not a JSON object")
+    return header, payload_size
+
+
+def recv_payload(sock, payload_size):
+    if not payload_size:
+        return {}
+    payload = io.BytesIO(_recv_exactly(sock, payload_size))
+    with np.load(payload, allow_pickle=False) as npz:
+        return dict((name, npz[name]) for name in npz.files)
+
+
+def recv_frame(sock):
+    header, payload_size = recv_header(sock)
+    return header, recv_payload(sock, payload_size)
+
+
+class DaemonClient(object):
+    """
+    Sends phasing requests to a running daemon; get_phase_sets has the
+    signature of PhAISession.get_phase_sets
+    """
+
+    def __init__(
+        self,
+        port=DEFAULT_PORT,
+        host="127.0.0.1",
+        timeout=3600,
+        token_file="",
+        version="",
+    ):
+        self.address = (host, int(port))
+        self.timeout = timeout
+        self.token_file = token_file or default_token_file(int(port))
+        # the PhAI version the daemon has to serve, checked by the daemon
+        self.version = version
+        # the precision the daemon's model runs at, from ping or the last
+        # request
+        self.precision = None
+
+    def request(self, header, arrays=None):
+        header = dict(header, token=read_token(self.token_file))
+        with socket.create_connection(self.address, timeout=self.timeout) as sock:
+            send_frame(sock, header, arrays)
+            reply, arrays = recv_frame(sock)
+        if not reply.get("ok"):
+            raise RuntimeError("PhAI daemon: %s" % reply.get("error"))
+        return reply, arrays
+
+    def ping(self):
+        """
+        Returns the status of the daemon ({"state": "loading"/"ready"/
+        "failed", ...}), or None if none is listening
+        """
+        try:
+            with socket.create_connection(self.address, timeout=1) as sock:
+                send_frame(sock, {"op": "ping"})
+                reply, arrays = recv_frame(sock)
+        except (OSError, ValueError):
+            return None
+        self.precision = reply.get("precision")
+        return reply
+
+    def get_phase_sets(
+        self,
+        f_sq_obs,
+        starts=1,
+        seed=None,
+        cycles=1,
+        INPUT_IS_SQUARED=True,
+        callback=None,
+        **kwargs
+    ):
+        # progress callbacks cannot cross the process boundary, and name_infile
+        # means nothing to the daemon
+        indices = f_sq_obs.indices().as_vec3_double().as_numpy_array()
+        arrays = {
+            "indices": indices.astype(np.int32),
+            "data": f_sq_obs.data().as_numpy_array(),
+        }
+        header = {
+            "op": "phase",
+            "version": self.version,
+            "options": {
+                "cycles": int(cycles),
+                "starts": int(starts),
+                "seed": seed,
+                "INPUT_IS_SQUARED": bool(INPUT_IS_SQUARED),
+            },
+        }
+        reply, arrays = self.request(header, arrays)
+        self.precision = reply.get("precision")
+        print("PhAI: phased by the daemon in %.2f s" % reply["seconds"])
+        return unpack_phase_sets(arrays)
+
+    def shutdown(self):
+        return self.request({"op": "shutdown"})
+
+
+class PhasingHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        try:
+            header, payload_size = recv_header(self.request)
+        except (OSError, ValueError) as e:
+            print("PhAI daemon: bad request: %s" % e)
+            return
+        op = header.get("op")
+        try:
+            # checked before the payload is read, so without the token
+            # nothing but the header is ever buffered
+            if op != "ping" and not self.server.authorized(header.get("token")):
+                raise PermissionError("missing or wrong token")
+            if op == "ping" and payload_size:
+                raise ValueError("ping takes no payload")
+            arrays = recv_payload(self.request, payload_size)
+            if op == "ping":
+                reply, out = self.server.status(), None
+            elif op == "phase":
+                reply, out = self.server.phase(header, arrays)
+            elif op == "shutdown":
+                reply, out = {}, None
+                threading.Thread(target=self.server.shutdown).start()
+            else:
+                raise ValueError("unknown request %r" % op)
+            reply["ok"] = True
+        except Exception as e:
+            reply, out = {"ok": False, "error": "%s: %s" % (type(e).__name__, e)}, None
+        try:
+            send_frame(self.request, reply, out)
+        except OSError:
+            pass
+
+
+class PhasingServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    # on Windows SO_REUSEADDR would let a second daemon bind the same port
+    # and overwrite the token file; there the port is bound exclusively
+    allow_reuse_address = sys.platform != "win32"
+
+    def server_bind(self):
+        if hasattr(socket, "SO_EXCLUSIVEADDRUSE"):
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_EXCLUSIVEADDRUSE, 1)
+        socketserver.ThreadingTCPServer.server_bind(self)
+
+    def __init__(
+        self,
+        port=DEFAULT_PORT,
+        precision="fp32",
+        threads=0,
+        interop_threads=0,
+        version="",
+        token_file="",
+    ):
+        from phai_registry import get_registry
+
+        socketserver.ThreadingTCPServer.__init__(
+            self, ("127.0.0.1", port), PhasingHandler
+        )
+        self.token_file = token_file or default_token_file(port)
+        self.token = write_token(self.token_file)
+        registry = get_registry()
+        if version:
+            registry.select(version)
+        self.version = registry.current
+        self.session = registry.session()
+        self.session.configure(precision, threads, interop_threads)
+        self.lock = threading.Lock()
+        self.loaded = threading.Event()
+        self.load_error = None
+        self.started = time.time()
+        self.served = 0
+        threading.Thread(target=self.load_model, daemon=True).start()
+
+    def load_model(self):
+        try:
+            self.session.load()
+        except Exception as e:
+            self.load_error = "%s: %s" % (type(e).__name__, e)
+            print("PhAI daemon: the model could not be loaded: %s" % self.load_error)
+        self.loaded.set()
+
+    def authorized(self, token):
+        return isinstance(token, str) and hmac.compare_digest(token, self.token)
+
+    def server_close(self):
+        socketserver.ThreadingTCPServer.server_close(self)
+        if read_token(self.token_file) == self.token:
+            os.remove(self.token_file)
+
+    def status(self):
+        if not self.loaded.is_set():
+            state = "loading"
+        else:
+            state = "failed" if self.load_error else "ready"
+        return {
+            "state": state,
+            "uptime_s": round(time.time() - self.started, 1),
+            "served": self.served,
+            "load_time_s": self.session.load_time,
+            "precision": self.session.precision,
+            "version": self.version,
+        }
+
+    def phase(self, header, arrays):
+        options = header.get("options", {})
+        unknown = set(options) - set(PHASE_OPTIONS)
+        if unknown:
+            raise ValueError("unsupported options %s" % ", ".join(sorted(unknown)))
+        options = dict(
+            (name, None if value is None else PHASE_OPTIONS[name](value))
+            for name, value in options.items()
+        )
+        version = header.get("version")
+        if version and version != self.version:
+            raise ValueError(
+                "this daemon serves %s, not %s" % (self.version, version)
+            )
+        self.loaded.wait()
+        if self.load_error:
+            raise RuntimeError("the model could not be loaded: %s" % self.load_error)
+
+        f_sq_obs = [
+            np.asarray(arrays["data"], dtype=np.float64),
+            np.asarray(arrays["indices"]).astype(int),
+        ]
+        t0 = time.perf_counter()
+        # one model, one request at a time
+        with self.lock:
+            sets = self.session.get_phase_sets(
+                f_sq_obs, name_infile="", **options
+            )
+            self.served += 1
+        seconds = time.perf_counter() - t0
+        print(
+            "PhAI daemon: %i reflections phased in %.2f s"
+            % (len(arrays["data"]), seconds)
+        )
+        reply = {
+            "seconds": seconds,
+            "precision": self.session.precision,
+        }
+        return reply, pack_phase_sets(sets)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--precision", choices=("fp32", "bf16"), default="fp32")
+    parser.add_argument("--threads", type=int, default=0)
+    parser.add_argument("--interop-threads", type=int, default=0)
+    parser.add_argument("--version", default="")
+    parser.add_argument("--token-file", default="")
+    args = parser.parse_args(argv)
+    server = PhasingServer(
+        args.port,
+        args.precision,
+        args.threads,
+        args.interop_threads,
+        args.version,
+        args.token_file,
+    )
+    print(
+        "PhAI daemon listening on 127.0.0.1:%i, token in %s"
+        % (args.port, server.token_file)
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+"""
+Headless PhAI solve: HKL file in, peak list or .res file out, no Olex2.
+
+    python phai_headless.py data.hkl [more.hkl ...] [--cell a b c al be ga]
+        [--space-group SYMBOL] [-n 5] [--seed 1]
+        [--fft-grid adaptive] [--peak-engine numpy] [-o DIR]
+        [--format res|peaks]
+
+Reflections are merged, phased, mapped and peak searched with the same code
+as the plugin (phai_pipeline). The crystal symmetry is read from a
+.ins/.res/.cif next to each HKL file unless --cell and --space-group are
+given. The model is loaded once and reused for every file, and each result
+is written to DIR/<name>_phai.res (or .peaks) as soon as it is ready.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import phai_pipeline
+from phai_hkl import read_hkl
+from phai_pipeline import compute_solution_peaks, flex_double, flex_miller_index
+from phai_session import get_session
+from phai_trace import Trace
+
+LATT_TYPES = "PIRFABC"
+
+
+def find_symmetry(hkl_path, cell=None, space_group=None):
+    """
+    Returns the crystal symmetry given on the command line or, failing
+    that, the one of a .ins/.res/.cif file next to `hkl_path` (or None)
+    """
+    from cctbx import crystal
+
+    if cell and space_group:
+        return crystal.symmetry(unit_cell=cell, space_group_symbol=space_group)
+    from iotbx import crystal_symmetry_from_any
+
+    stem = os.path.splitext(hkl_path)[0]
+    for ext in (".ins", ".res", ".cif"):
+        if os.path.exists(stem + ext):
+            cs = crystal_symmetry_from_any.extract_from(stem + ext)
+            if cs is not None and cs.unit_cell() is not None:
+                return cs
+    return None
+
+
+def merge_reflections(hkl, f, sigma, crystal_symmetry):
+    """
+    Returns the merged intensities of the HKLF 4 arrays from read_hkl
+    """
+    miller = phai_pipeline.miller
+    i_obs = miller.array(
+        miller_set=miller.set(
+            crystal_symmetry=crystal_symmetry,
+            indices=flex_miller_index(hkl),
+            anomalous_flag=False,
+        ),
+        data=flex_double(f),
+        sigmas=flex_double(sigma),
+    ).set_observation_type_xray_intensity()
+    return i_obs.merge_equivalents().array()
+
+
+def symmetry_lines(space_group):
+    """
+    Returns the LATT and SYMM instructions of a cctbx space group
+    """
+    centring = space_group.conventional_centring_type_symbol()
+    latt = LATT_TYPES.index(centring) + 1
+    if space_group.is_centric() and space_group.is_origin_centric():
+        inversions = 1
+    else:
+        # an inversion centre off the origin has to be listed explicitly
+        latt = -latt
+        inversions = space_group.f_inv()
+    lines = ["LATT %i" % latt]
+    for i_inv in range(inversions):
+        for i_smx in range(space_group.n_smx()):
+            op = space_group(0, i_inv, i_smx)
+            if op.is_unit_mx():
+                continue
+            lines.append("SYMM " + op.as_xyz(decimal=True).upper())
+    return lines
+
+
+def write_res(path, title, crystal_symmetry, peaks, wavelength=0.71073):
+    """
+    Writes the peaks as Q-peaks of a SHELX .res file
+    """
+    lines = [
+        "TITL %s solved by PhAI" % title,
+        "CELL %.5f %.4f %.4f %.4f %.3f %.3f %.3f"
+        % ((wavelength,) + crystal_symmetry.unit_cell().parameters()),
+        "ZERR 1 0 0 0 0 0 0",
+    ]
+    lines += symmetry_lines(crystal_symmetry.space_group())
+    lines += ["SFAC C", "UNIT 1", "FVAR 1.0"]
+    for i, (xyz, height) in enumerate(zip(peaks.sites(), peaks.heights())):
+        lines.append(
+            "Q%i 1 %.5f %.5f %.5f 11.00000 0.05 %.2f" % ((i + 1,) + tuple(xyz) + (height,))
+        )
+    lines += ["HKLF 4", "END"]
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def write_peaks(path, peaks):
+    """
+    Writes the peaks as a tab separated list of fractional sites and heights
+    """
+    with open(path, "w") as f:
+        f.write("peak\tx\ty\tz\theight\n")
+        for i, (xyz, height) in enumerate(zip(peaks.sites(), peaks.heights())):
+            f.write("Q%i\t%.5f\t%.5f\t%.5f\t%.3f\n" % ((i + 1,) + tuple(xyz) + (height,)))
+
+
+def solve(
+    hkl_path,
+    crystal_symmetry,
+    cycles=5,
+    max_peaks="auto",
+    seed=None,
+    trace=None,
+    **settings
+):
+    """
+    Runs the whole pipeline on one HKL file and returns its peaks
+    """
+    if trace is None:
+        trace = Trace(os.path.basename(hkl_path))
+    with trace.stage("hkl parsing"):
+        hkl, f, sigma = read_hkl(hkl_path, use_cache=False)
+    with trace.stage("reflection merging"):
+        f_sq_obs = merge_reflections(hkl, f, sigma, crystal_symmetry)
+    return compute_solution_peaks(
+        f_sq_obs, cycles, max_peaks, trace=trace, seed=seed, **settings
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("hkl", nargs="+")
+    parser.add_argument("--cell", type=float, nargs=6)
+    parser.add_argument("--space-group")
+    parser.add_argument("-n", "--cycles", type=int, default=5)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--max-peaks", default="auto")
+    parser.add_argument("--fft-grid", choices=("fixed", "adaptive"), default="fixed")
+    parser.add_argument("--resolution-factor", type=float, default=1.0 / 3)
+    parser.add_argument("--use-symmetry", action="store_true")
+    parser.add_argument("--peak-engine", choices=("cctbx", "numpy"), default="cctbx")
+    parser.add_argument("-o", "--out-dir", default=".")
+    parser.add_argument("--format", choices=("res", "peaks"), default="res")
+    parser.add_argument("--trace-log", default="")
+    args = parser.parse_args(argv)
+
+    t0 = time.perf_counter()
+    phai_pipeline.import_cctbx()
+    get_session().load()
+    print("PhAI: imports and model load took %.2f s" % (time.perf_counter() - t0))
+    os.makedirs(args.out_dir, exist_ok=True)
+
+    failed = 0
+    for hkl_path in args.hkl:
+        name = os.path.splitext(os.path.basename(hkl_path))[0]
+        cs = find_symmetry(hkl_path, args.cell, args.space_group)
+        if cs is None:
+            print("%s: no crystal symmetry, use --cell/--space-group" % hkl_path)
+            failed += 1
+            continue
+        trace = Trace(name)
+        try:
+            peaks = solve(
+                hkl_path,
+                cs,
+                args.cycles,
+                args.max_peaks,
+                seed=args.seed,
+                trace=trace,
+                fft_grid=args.fft_grid,
+                resolution_factor=args.resolution_factor,
+                use_symmetry=args.use_symmetry,
+                peak_engine=args.peak_engine,
+            )
+        except Exception as e:
+            print("%s: failed: %s" % (hkl_path, e))
+            failed += 1
+            continue
+        output = os.path.join(args.out_dir, "%s_phai.%s" % (name, args.format))
+        with trace.stage("writing"):
+            if args.format == "res":
+                write_res(output, name, cs, peaks)
+            else:
+                write_peaks(output, peaks)
+        print("%s: %i peaks written to %s" % (hkl_path, len(peaks.heights()), output))
+        print(trace.summary())
+        if args.trace_log:
+            trace.append_jsonl(args.trace_log)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,221 @@
+"""
+Reading of HKL files into typed numpy arrays.
+
+SHELX HKLF 4 files are fixed width (3I4, 2F8.2, ...), so while the lines have
+the same length as the first one the fields are cut out of the raw bytes;
+what follows has to start with the terminating 0 0 0 line. Right aligned,
+with the decimal point in the same column on every line, each column of a
+field has a fixed place value and the numbers are a matrix product of the
+digits. Anything else is read as whitespace separated columns, which have to
+be the same number on every line up to the terminating 0 0 0 line.
+
+The parsed reflections are kept next to the HKL file as
+<name>.hkl.<size>-<mtime>.phai.npy and memory mapped on the next read, so
+repeat runs on the same data skip the parsing completely.
+"""
+
+import glob
+import os
+
+import numpy as np
+
+HKL_DTYPE = np.dtype(
+    [("hkl", np.int32, (3,)), ("f", np.float64), ("sigma", np.float64)]
+)
+
+# (start, end) of h, k, l, F and sigma in a SHELX HKL line
+HKL_FIELDS = ((0, 4), (4, 8), (8, 12), (12, 20), (20, 28))
+
+
+def cache_path(path):
+    st = os.stat(path)
+    return "%s.%i-%i.phai.npy" % (path, st.st_size, st.st_mtime_ns)
+
+
+def _place_values(first, start, end, integer):
+    """
+    Returns the place value of every column of the field start:end, whose
+    decimal point (if any) sits where it does in the `first` line, and the
+    power of ten the digits are divided by; None for a decimal point in an
+    integer field
+    """
+    width = end - start
+    point = first.find(b".", start, end) - start
+    if point >= 0 and integer:
+        return None
+    column = np.arange(width)
+    if point < 0:
+        return 10.0 ** (width - 1 - column), 1.0
+    # digits to the right of every column, the decimal point not counted
+    places = 10.0 ** (width - 1 - column - (column < point))
+    places[point] = 0.0
+    return places, 10.0 ** (width - 1 - point)
+
+
+def _parse_fixed_width(buf):
+    raw = np.frombuffer(buf, dtype=np.uint8)
+    width = buf.find(b"\n") + 1
+    if width <= HKL_FIELDS[-1][1]:
+        return None
+    # the lines up to the first one of another width, such as a CELL line
+    # after the terminator
+    ends = np.flatnonzero(raw == ord("\n"))
+    n = min(len(ends), len(buf) // width)
+    moved = np.flatnonzero(ends[:n] != np.arange(width - 1, n * width, width))
+    if len(moved):
+        n = moved[0]
+    table = raw[: n * width].reshape(n, width)
+    rest = buf[n * width :].split(None, 3)[:3]
+    # only trust the columns if they agree with a plain split of the first
+    # line; when fields run into each other it has fewer tokens than fields
+    try:
+        fixed = [float(buf[a:b]) for a, b in HKL_FIELDS]
+    except ValueError:
+        return None
+    first = buf[: HKL_FIELDS[-1][1]].split()
+    if len(first) == len(HKL_FIELDS) and fixed != [float(x) for x in first]:
+        return None
+
+    n_columns = HKL_FIELDS[-1][1]
+    places = np.zeros((n_columns, len(HKL_FIELDS)))
+    divisors = np.ones(len(HKL_FIELDS))
+    for i, (a, b) in enumerate(HKL_FIELDS):
+        field = _place_values(buf, a, b, i < 3)
+        if field is None:
+            return None
+        places[a:b, i], divisors[i] = field
+
+    table = np.ascontiguousarray(table[:, :n_columns])
+    digits = table - np.uint8(ord("0"))  # wraps around for anything else
+    is_digit = digits < 10
+    blank = table == ord(" ")
+    minus = table == ord("-")
+    dot = table == ord(".")
+    # the classes do not overlap, so together they have to cover every byte
+    classes = (is_digit, blank, minus, dot)
+    if sum(np.count_nonzero(c) for c in classes) != table.size:
+        return None
+    # every line has its decimal points where the first one has them
+    points = np.flatnonzero(places.any(axis=1) == 0)
+    if np.count_nonzero(dot) != n * len(points) or not dot[:, points].all():
+        return None
+    # fields are right aligned: the last column is a digit, and a blank or
+    # sign may only follow a blank
+    if not is_digit[:, [b - 1 for a, b in HKL_FIELDS]].all():
+        return None
+    follows = blank | minus
+    follows[:, [a for a, b in HKL_FIELDS]] = False
+    if (~blank.ravel()[:-1] & follows.ravel()[1:]).any():
+        return None
+
+    # the digits times their place values sum up to an exact integer, in
+    # float32 as long as it stays below 2**24; dividing it by an exact power
+    # of ten then rounds the same way float() does
+    digits *= is_digit
+    dtype = np.float32 if 10 * places.max() <= 2 ** 24 else np.float64
+    values = np.dot(digits.astype(dtype), places.astype(dtype))
+    # all fields start and end on a multiple of 4 bytes, so a field is
+    # negative if one of its 4-byte words holds the minus sign
+    words = np.zeros((n_columns // 4, len(HKL_FIELDS)), dtype=np.float32)
+    for i, (a, b) in enumerate(HKL_FIELDS):
+        words[a // 4 : b // 4, i] = 1
+    negative = np.dot((minus.view(np.uint32) != 0).astype(np.float32), words)
+    values = values.astype(np.float64)
+    values *= 1 - 2 * negative
+    values /= divisors
+    # lines of another width are only allowed after the terminator
+    if rest and rest != [b"0"] * 3 and values[:, :3].any(axis=1).all():
+        return None
+    data = np.empty(n, dtype=HKL_DTYPE)
+    data["hkl"] = values[:, :3]
+    data["f"] = values[:, 3]
+    data["sigma"] = values[:, 4]
+    return data
+
+
+def _parse_whitespace(buf):
+    rows = [line.split() for line in buf.splitlines()]
+    rows = [row for row in rows if row]
+    if not rows:
+        return np.zeros(0, dtype=HKL_DTYPE)
+    n_cols = len(rows[0])
+    if n_cols < 4:
+        raise ValueError("HKL line 1 has %i columns, expected at least 4" % n_cols)
+    for i, row in enumerate(rows):
+        if len(row) == n_cols:
+            continue
+        # anything after the terminating 0 0 0 line is not read
+        if any(not any(int(x) for x in r[:3]) for r in rows[:i]):
+            rows = rows[:i]
+            break
+        raise ValueError(
+            "HKL line %i has %i columns, expected %i" % (i + 1, len(row), n_cols)
+        )
+    values = np.array(rows, dtype=np.float64)
+    data = np.zeros(len(values), dtype=HKL_DTYPE)
+    data["hkl"] = values[:, 0:3]
+    data["f"] = values[:, 3]
+    if n_cols > 4:
+        data["sigma"] = values[:, 4]
+    return data
+
+
+def parse_hkl(path):
+    """
+    Returns the reflections in `path` as a HKL_DTYPE array, up to the
+    terminating 0 0 0 line.
+    """
+    with open(path, "rb") as f:
+        buf = f.read()
+    if b"\r" in buf:
+        buf = buf.replace(b"\r", b"")
+    if not buf.endswith(b"\n"):
+        buf += b"\n"
+    data = _parse_fixed_width(buf)
+    if data is None:
+        data = _parse_whitespace(buf)
+    end = np.flatnonzero(~data["hkl"].any(axis=1))
+    if len(end):
+        data = data[: end[0]]
+    return data
+
+
+def default_hkl():
+    """
+    Returns the path of the COD_2016452.hkl test file bundled with
+    ai_for_olex.PhAI
+    """
+    import importlib.resources
+
+    path_testing_dir = importlib.resources.files("ai_for_olex.PhAI.test_files")
+    return str(path_testing_dir / "COD_2016452.hkl")
+
+
+def read_hkl(path, use_cache=True):
+    """
+    Returns (hkl, f, sigma) for the HKL file `path`, using the parsed cache
+    next to it when its size and modification time still match.
+    """
+    if not use_cache:
+        data = parse_hkl(path)
+        return data["hkl"], data["f"], data["sigma"]
+
+    cached = cache_path(path)
+    if os.path.exists(cached):
+        # copy-on-write, so callers may modify the arrays in memory
+        data = np.load(cached, mmap_mode="c")
+    else:
+        data = parse_hkl(path)
+        for stale in glob.glob(glob.escape(path) + ".*.phai.npy"):
+            try:
+                os.remove(stale)
+            except OSError:
+                pass
+        tmp = cached + ".tmp"
+        try:
+            with open(tmp, "wb") as f:
+                np.save(f, data)
+            os.replace(tmp, cached)
+        except OSError as e:
+            print("Could not write the HKL cache %s: %s" % (cached, e))
+    return data["hkl"], data["f"], data["sigma"]
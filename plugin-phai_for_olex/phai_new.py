@@ -7,6 +7,8 @@ import htmlTools
 import olex
 import olx
 import gui
+import shutil
+import subprocess
 import time
 
 debug = bool(OV.GetParam("olex2.debug", False))
@@ -39,7 +41,14 @@ OV.SetVar("phai_new_plugin_path", p_path)
 from PluginTools import PluginTools as PT
 
 # from PluginLib.plugin-phai_new.PhAI_for_olex2 import _create_solution_map
-from PhAI_for_olex2 import create_solution_map
+from PhAI_for_olex2 import create_solution_map, start_solution_map
+from PhAI_for_olex2 import poll_job, cancel_job, get_timings
+from PhAI_for_olex2 import create_candidate_maps, post_peaks, job_running
+from phai_session import get_session, unload_session
+from phai_cache import PhaseCache
+from phai_daemon import DaemonClient
+from phai_registry import get_registry
+from phai_candidates import candidate_path, select_best_candidate
 
 
 class phai_new(PT):
@@ -57,6 +66,13 @@ class phai_new(PT):
         OV.registerFunction(self.print_formula, True, "phai_new")
         OV.registerFunction(self.create_solution_map, True, "phai_new")
         OV.registerFunction(self.solve, True, "phai_new")
+        OV.registerFunction(self.unload_model, True, "phai_new")
+        OV.registerFunction(self.poll_job, True, "phai_new")
+        OV.registerFunction(self.cancel_job, True, "phai_new")
+        OV.registerFunction(self.clear_cache, True, "phai_new")
+        OV.registerFunction(self.start_daemon, True, "phai_new")
+        OV.registerFunction(self.stop_daemon, True, "phai_new")
+        OV.registerFunction(self.get_timings, True, "phai_new")
         OV.registerFunction(self.print_hkl_info, False, "phai_new")
         OV.registerFunction(self.get_cycles, False, "phai_new")
         OV.registerFunction(self.get_versions_phai, False, "phai_new")
@@ -67,27 +83,284 @@ class phai_new(PT):
 
         # END Generated =======================================
 
-    def create_solution_map(self, cycles=5, max_peaks="auto"):
-        print("BANANA")
-        create_solution_map(cycles, max_peaks)
-        print("Apple")
+    def create_solution_map(self, cycles=5, max_peaks="auto", on_done=None):
+        # configure_inference may reload the model a running job is using
+        if job_running():
+            return
+        self.configure_inference()
+        settings = self.get_run_settings()
+        settings["trace_log"] = OV.GetParam("phai_new.variables.trace_log", "")
+        if OV.GetParam("phai_new.variables.background", False):
+            start_solution_map(cycles, max_peaks, on_done, **settings)
+            return
+        posted = create_solution_map(cycles, max_peaks, **settings)
+        if posted is not None and on_done is not None:
+            on_done()
+
+    def select_version(self):
+        """
+        Selects the version of the phil in the registry and returns the
+        selected one; a version that is not available is replaced by the
+        current one, also in the phil
+        """
+        registry = self.get_registry()
+        name = OV.GetParam("phai_new.variables.name_phai", "")
+        if name and not registry.select(name):
+            OV.SetParam("phai_new.variables.name_phai", registry.current)
+        return registry.current
+
+    def configure_inference(self):
+        self.select_version()
+        get_session().configure(
+            OV.GetParam("phai_new.inference.precision", "fp32"),
+            OV.GetParam("phai_new.inference.threads", 0),
+            OV.GetParam("phai_new.inference.interop_threads", 0),
+        )
+
+    def get_run_settings(self):
+        """
+        Collects the phil settings create_solution_map passes on to the
+        phasing stage
+        """
+        seed = OV.GetParam("phai_new.variables.seed", 0)
+        version = self.select_version()
+        cache = None
+        if OV.GetParam("phai_new.cache.enabled", True):
+            cache = PhaseCache(
+                self.cache_directory(), OV.GetParam("phai_new.cache.max_mb", 256)
+            )
+        return {
+            "seed": seed or None,
+            "version": version,
+            "cache": cache,
+            "fft_grid": OV.GetParam("phai_new.map.fft_grid", "fixed"),
+            "resolution_factor": OV.GetParam("phai_new.map.resolution_factor", 1.0 / 3),
+            "use_symmetry": OV.GetParam("phai_new.map.use_symmetry", False),
+            "peak_engine": OV.GetParam("phai_new.map.peak_engine", "cctbx"),
+            "daemon_port": OV.GetParam("phai_new.daemon.port", 8765)
+            if OV.GetParam("phai_new.daemon.enabled", False)
+            else 0,
+        }
+
+    def cache_directory(self):
+        cache_dir = OV.GetParam("phai_new.cache.directory", "")
+        return cache_dir or os.path.join(instance_path, "phai_cache")
+
+    def clear_cache(self):
+        """
+        Empties the phase cache, also when the cache is disabled and only
+        holds results from before
+        """
+        cache_dir = self.cache_directory()
+        if not os.path.isdir(cache_dir):
+            print("The PhAI cache is empty.")
+            return
+        PhaseCache(cache_dir, OV.GetParam("phai_new.cache.max_mb", 256)).clear()
+        print("PhAI cache cleared.")
+
+    def start_daemon(self):
+        """
+        Starts phai_daemon.py in its own process unless one is already
+        listening on the configured port
+        """
+        port = OV.GetParam("phai_new.daemon.port", 8765)
+        if DaemonClient(port).ping() is not None:
+            print("PhAI daemon already running on port %i." % port)
+            return
+        python = self.find_python()
+        if not python:
+            print(
+                "No Python interpreter with numpy and ai_for_olex found, "
+                "set phai_new.daemon.python to one."
+            )
+            return
+        subprocess.Popen(
+            [
+                python,
+                os.path.join(p_path, "phai_daemon.py"),
+                "--port",
+                str(port),
+                "--precision",
+                OV.GetParam("phai_new.inference.precision", "fp32"),
+                "--threads",
+                str(OV.GetParam("phai_new.inference.threads", 0)),
+                "--interop-threads",
+                str(OV.GetParam("phai_new.inference.interop_threads", 0)),
+                "--version",
+                self.select_version(),
+            ],
+            cwd=p_path,
+            creationflags=getattr(subprocess, "CREATE_NO_WINDOW", 0),
+        )
+        OV.SetParam("phai_new.daemon.enabled", True)
+        print("PhAI daemon starting on port %i with %s." % (port, python))
+
+    def find_python(self):
+        """
+        Returns the configured Python interpreter, or else the first python3 or
+        python on the PATH, if it can import what phai_daemon.py needs
+        """
+        configured = OV.GetParam("phai_new.daemon.python", "")
+        if configured:
+            candidates = [configured]
+        else:
+            candidates = [shutil.which("python3"), shutil.which("python")]
+        for python in candidates:
+            if not python:
+                continue
+            try:
+                check = subprocess.run(
+                    [python, "-c", "import numpy, ai_for_olex"],
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                    timeout=60,
+                    creationflags=getattr(subprocess, "CREATE_NO_WINDOW", 0),
+                )
+            except (OSError, subprocess.SubprocessError):
+                continue
+            if check.returncode == 0:
+                return python
+            print("PhAI: %s cannot import numpy and ai_for_olex." % python)
+        return ""
+
+    def stop_daemon(self):
+        port = OV.GetParam("phai_new.daemon.port", 8765)
+        if DaemonClient(port).ping() is None:
+            print("No PhAI daemon running on port %i." % port)
+            return
+        DaemonClient(port).shutdown()
+        print("PhAI daemon on port %i stopped." % port)
+
+    def get_timings(self):
+        """
+        Returns (and prints) the stage timings of the last PhAI run
+        """
+        timings = get_timings()
+        print(timings or "PhAI has not run yet.")
+        return timings
+
+    def poll_job(self):
+        poll_job()
+
+    def cancel_job(self):
+        if not cancel_job():
+            print("PhAI is not running.")
+
+    def unload_model(self):
+        if job_running():
+            return
+        if not unload_session():
+            print("No PhAI model loaded.")
 
     def solve(self, cycles=5, max_peaks="auto"):
+        if job_running():
+            return
         olex.m('fuse')
         olex.m('reset')
-        self.create_solution_map(cycles, max_peaks)
+        candidates = int(OV.GetParam("phai_new.solve.candidates", 1))
+        if candidates > 1:
+            self.solve_candidates(cycles, max_peaks, candidates)
+            return
+        self.create_solution_map(cycles, max_peaks, on_done=self.refine_solution)
+
+    def solve_candidates(self, cycles, max_peaks, candidates):
+        """
+        Maps `candidates` random starts, refines each of them in its own
+        process and loads the refined model of the one with the lowest R1
+        """
+        self.configure_inference()
+        settings = self.get_run_settings()
+        settings["trace_log"] = OV.GetParam("phai_new.variables.trace_log", "")
+        peak_sets = create_candidate_maps(cycles, max_peaks, candidates, **settings)
+        if not peak_sets:
+            return
+        best, r1 = select_best_candidate(
+            peak_sets,
+            OV.GetParam("phai_new.solve.refine_program", "shelxl"),
+            OV.GetParam("phai_new.solve.refine_cycles", 4),
+            OV.GetParam("phai_new.solve.workers", 0),
+        )
+        if best is None:
+            print("PhAI: continuing with the first candidate")
+            post_peaks(peak_sets[0].sites(), peak_sets[0].heights())
+            self.refine_solution()
+            return
+        # the candidate is already refined, its .res replaces the structure's
+        res = os.path.splitext(OV.FileFull())[0] + ".res"
+        shutil.copyfile(candidate_path(best), res)
+        olex.m("reap '%s'" % res)
+        print("PhAI: loaded candidate %i, R1 = %.4f" % (best + 1, r1))
+
+    def refine_solution(self):
         olex.m('sel $Q')
         olex.m('name C')
         #olex.m('ata')
 
-        for i in range(3):
+        max_iterations = OV.GetParam("phai_new.refine.max_iterations", 3)
+        history = []
+        for i in range(max_iterations):
             olex.m("ata(1)")
-            olex.m("refine 4")
+            state = self.check_refinement(history, self.run_refinement())
+            if state:
+                break
             olex.m("ata(1)")
             olex.m("compaq")
             olex.m("grow")
             olex.m("anis")
-            olex.m("refine 4")
+            state = self.check_refinement(history, self.run_refinement())
+            if state:
+                break
+        else:
+            state = "not converged"
+        print(
+            "PhAI refinement %s after %i refinement(s), R1 = %s"
+            % (state, len(history), history[-1] if history else "-")
+        )
+
+    def run_refinement(self, cycles=4):
+        """
+        Refines and returns its R1 and max shift/esd; R1 is None if the
+        refinement did not set it
+        """
+        # cleared, so a failed refinement cannot leave the previous R1
+        OV.SetParam("snum.refinement.last_R1", None)
+        olex.m("refine %i" % cycles)
+        return self.refinement_stats()
+
+    def refinement_stats(self):
+        """
+        Returns R1 and max shift/esd of the last refinement, None if unknown
+        """
+        stats = []
+        for name in ("last_R1", "max_shift_over_esd"):
+            try:
+                stats.append(abs(float(OV.GetParam("snum.refinement." + name))))
+            except (TypeError, ValueError):
+                stats.append(None)
+        return stats
+
+    def check_refinement(self, history, stats):
+        """
+        Records the R1 of the refinement with `stats` (from run_refinement)
+        in `history` and returns "converged", "diverging" or "failed" if the
+        refinement loop should stop
+        """
+        r1, shift = stats
+        if r1 is None:
+            return "failed"
+        print("PhAI refinement: R1 = %.4f, max shift/esd = %s" % (r1, shift))
+        history.append(r1)
+        if r1 > OV.GetParam("phai_new.refine.max_r1", 0.6):
+            return "diverging"
+        if len(history) < 2:
+            return None
+        if r1 - min(history) > OV.GetParam("phai_new.refine.max_r1_increase", 0.05):
+            return "diverging"
+        max_shift = OV.GetParam("phai_new.refine.max_shift", 0.05)
+        if abs(history[-2] - r1) < OV.GetParam("phai_new.refine.r1_tolerance", 0.002):
+            if shift is None or shift <= max_shift:
+                return "converged"
+        return None
 
     def print_formula(self):
         formula = {}
@@ -122,36 +395,43 @@ class phai_new(PT):
         # OV.SetParam("phai_new.variables.fvarocc", fvar)
         return cycles
 
+    def get_registry(self):
+        """
+        Returns the model registry, set up with the size limit of the phil
+        """
+        registry = get_registry()
+        registry.max_models = max(1, OV.GetParam("phai_new.models.max_models", 2))
+        registry.evict()
+        return registry
+
     def get_versions_phai(self):
-        versions = ['PhAI_P21_c']
-        # db = FragmentTable(self.dbfile, self.userdbfile)
-        # items = ";".join(["{}<-{}".format(i[1], i[0]) for i in db])
-        return versions
+        return self.get_registry().versions()
 
-    def set_id(self, fragid=0):
+    def set_id(self, version_id=0):
         """
-        Sets the fragment id in the phil for the search field
+        Selects the PhAI version with index `version_id` in the list of
+        versions; it is loaded when it is first used
         """
         try:
-          int(fragid)
-        except(ValueError):
-          return False
-        # print('### Selected fragment {}'.format(fragid))
-        OV.SetParam("phai_new.variables.version_phai", version_phai)
-        self.version_phai = int(version_phai)
+            version_id = int(version_id)
+            name = self.get_versions_phai()[version_id]
+        except (ValueError, IndexError):
+            return False
+        if not self.get_registry().select(name):
+            return False
+        OV.SetParam("phai_new.variables.version_phai", version_id)
+        OV.SetParam("phai_new.variables.name_phai", name)
+        self.version_phai = version_id
         return True
 
     def list_versions(self):
-      """
-      returns the available fragments in the database
-      the list of names is separated by semicolon
-      i[0] => number
-      i[1] => name
-      """
-      # db = FragmentTable(self.dbfile, self.userdbfile)
-      # items = ';'.join(['{}<-{}'.format(i[1], i[0]) for i in db])
-      items = self.get_versions_phai()
-      olx.html.SetItems('LIST_PHAI_VERSIONS', items)
+        """
+        Returns the available PhAI versions as items of LIST_PHAI_VERSIONS,
+        name<-index separated by semicolons
+        """
+        return ";".join(
+            "%s<-%i" % (name, i) for i, name in enumerate(self.get_versions_phai())
+        )
 
     def init_plugin(self):
       """
@@ -166,8 +446,14 @@ class phai_new(PT):
       # OV.SetParam('FragmentDB.fragment.resinum', resinum)
       # #self.list_all_fragments()
 
-      OV.SetParam('phai_new.variables.name_phai', self.get_versions_phai()[0])
-      olx.html.SetValue('LIST_PHAI_VERSIONS', self.list_versions() )# OV.GetParam('FragmentDB.new_fragment.frag_name'))
+      versions = self.get_versions_phai()
+      name = OV.GetParam('phai_new.variables.name_phai', '')
+      if name not in versions:
+        name = versions[0]
+        OV.SetParam('phai_new.variables.name_phai', name)
+      self.get_registry().select(name)
+      olx.html.SetItems('LIST_PHAI_VERSIONS', self.list_versions())
+      olx.html.SetValue('LIST_PHAI_VERSIONS', name)# OV.GetParam('FragmentDB.new_fragment.frag_name'))
 
 
 
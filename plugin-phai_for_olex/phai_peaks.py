@@ -0,0 +1,137 @@
+"""
+Peak search on a map grid with numpy, as an alternative to cctbx peak_search.
+
+Every grid point higher than or equal to its 26 neighbours (periodic
+boundaries) is a candidate. Its position and height are refined by fitting a
+parabola along each grid axis. The candidates are then accepted from the
+highest down. Each accepted peak removes every lower candidate within
+`min_distance` of any of its symmetry equivalents and lattice translations.
+The neighbours are looked up with a scipy cKDTree if available, otherwise
+with a brute-force minimum image distance.
+"""
+
+import itertools
+
+import numpy as np
+
+# the 27 lattice translations of the unit cell and its direct neighbours
+_TRANSLATIONS = np.array(list(itertools.product((-1, 0, 1), repeat=3)), dtype=float)
+
+
+class PeakList(object):
+    """
+    Peaks in the form post_peaks and the candidate refinement expect from a
+    cctbx peak search result
+    """
+
+    def __init__(self, sites, heights):
+        self._sites = [tuple(float(x) for x in xyz) for xyz in sites]
+        self._heights = [float(h) for h in heights]
+
+    def sites(self):
+        return self._sites
+
+    def heights(self):
+        return self._heights
+
+    def __len__(self):
+        return len(self._heights)
+
+
+def local_maxima(data):
+    """
+    Returns the grid indices of the local maxima of the periodic map `data`
+    """
+    is_max = np.ones(data.shape, dtype=bool)
+    for shift in itertools.product((-1, 0, 1), repeat=3):
+        if shift != (0, 0, 0):
+            is_max &= data >= np.roll(data, shift, axis=(0, 1, 2))
+    return np.argwhere(is_max)
+
+
+def interpolate(data, points):
+    """
+    Returns fractional sites and heights of the grid `points` refined by a
+    parabola through each point and its two neighbours along every axis
+    """
+    n = np.array(data.shape)
+    centre = data[tuple(points.T)]
+    offsets = np.zeros(points.shape)
+    heights = centre.copy()
+    for axis in range(3):
+        step = np.zeros(3, dtype=int)
+        step[axis] = 1
+        minus = data[tuple(((points - step) % n).T)]
+        plus = data[tuple(((points + step) % n).T)]
+        curvature = minus - 2 * centre + plus
+        with np.errstate(divide="ignore", invalid="ignore"):
+            offset = np.where(curvature < 0, 0.5 * (minus - plus) / curvature, 0.0)
+        offset = np.clip(offset, -0.5, 0.5)
+        offsets[:, axis] = offset
+        heights += -0.25 * (minus - plus) * offset
+    return ((points + offsets) / n) % 1.0, heights
+
+
+def symmetry_operations(space_group):
+    ops = []
+    for op in space_group.all_ops():
+        ops.append(
+            (
+                np.array(op.r().as_double()).reshape(3, 3),
+                np.array(op.t().as_double()),
+            )
+        )
+    return ops
+
+
+def find_peaks(
+    data,
+    unit_cell,
+    space_group,
+    max_peaks,
+    min_distance,
+    max_candidates=None,
+):
+    """
+    Returns a PeakList of at most `max_peaks` peaks of the map `data` (a
+    3D numpy array over the whole unit cell), no two of them or their
+    symmetry equivalents closer than `min_distance` (A)
+    """
+    points = local_maxima(data)
+    order = np.argsort(-data[tuple(points.T)], kind="stable")
+    # far more candidates than peaks are never needed
+    if max_candidates is None:
+        max_candidates = max(1000, 20 * max_peaks)
+    points = points[order[:max_candidates]]
+    sites, heights = interpolate(data, points)
+    order = np.argsort(-heights, kind="stable")
+    sites, heights = sites[order], heights[order]
+
+    # scipy is optional and slow to import, only needed here
+    try:
+        from scipy.spatial import cKDTree
+    except ImportError:
+        cKDTree = None
+
+    orth = np.array(unit_cell.orthogonalization_matrix()).reshape(3, 3)
+    ops = symmetry_operations(space_group)
+    tree = cKDTree(sites.dot(orth.T)) if cKDTree is not None else None
+    suppressed = np.zeros(len(sites), dtype=bool)
+    accepted = []
+    for i in range(len(sites)):
+        if suppressed[i]:
+            continue
+        accepted.append(i)
+        if len(accepted) >= max_peaks:
+            break
+        equivalents = np.array([r.dot(sites[i]) + t for r, t in ops]) % 1.0
+        if tree is not None:
+            images = (equivalents[:, None, :] + _TRANSLATIONS[None, :, :]).reshape(-1, 3)
+            for near in tree.query_ball_point(images.dot(orth.T), min_distance):
+                suppressed[near] = True
+        else:
+            diff = sites[None, :, :] - equivalents[:, None, :]
+            diff -= np.rint(diff)
+            distance = np.sqrt((diff.dot(orth.T) ** 2).sum(axis=-1)).min(axis=0)
+            suppressed |= distance < min_distance
+    return PeakList(sites[accepted], heights[accepted])
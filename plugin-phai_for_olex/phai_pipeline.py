@@ -0,0 +1,373 @@
+"""
+The cctbx side of a PhAI run, independent of Olex2: merged reflections in,
+phase sets and map peaks out.
+
+cctbx is only imported by import_cctbx(), on the first run, so importing
+this module stays cheap.
+"""
+
+import time
+
+import numpy as np
+
+from phai_daemon import DaemonClient
+from phai_peaks import find_peaks
+from phai_session import get_session
+from phai_trace import Trace
+
+maptbx = miller = flex = sgtbx = None
+
+
+def import_cctbx():
+    global maptbx, miller, flex, sgtbx
+    from cctbx import maptbx
+    from cctbx import miller
+    from cctbx.array_family import flex
+    from cctbx import sgtbx
+
+
+# names of the converters this cctbx build refused a numpy buffer for
+flex_without_numpy = set()
+
+
+def _from_numpy(name, from_buffer, from_list):
+    """
+    Builds a flex array straight from a numpy buffer, or through a python
+    list if this cctbx build refused the buffer for the converter `name`
+    before.
+    """
+    if name not in flex_without_numpy:
+        try:
+            return from_buffer()
+        except (TypeError, ValueError, RuntimeError) as e:
+            flex_without_numpy.add(name)
+            print("PhAI: %s cannot take numpy arrays (%s), using lists" % (name, e))
+    return from_list()
+
+
+def flex_double(a):
+    a = np.ascontiguousarray(a, dtype=np.float64)
+    return _from_numpy(
+        "flex.double", lambda: flex.double(a), lambda: flex.double(a.tolist())
+    )
+
+
+def flex_miller_index(hkl_array):
+    hkl = np.asarray(hkl_array, dtype=np.int32).reshape(-1, 3)
+    # miller_index has a constructor from three flex.int columns h, k, l
+    return _from_numpy(
+        "flex.miller_index",
+        lambda: flex.miller_index(
+            *[flex.int(np.ascontiguousarray(hkl[:, i])) for i in range(3)]
+        ),
+        lambda: flex.miller_index(hkl.tolist()),
+    )
+
+
+def millering(f_sq_obs, hkl_array, amplitudes_ord, ph):
+    # try:
+    # multiply Fs with the phases (given in degrees):
+    C_Fs = flex.polar(flex_double(amplitudes_ord), flex_double(ph), True)
+    # for c_number in list(C_Fs):
+    #     print(c_number)
+    miller_set = miller.array(
+        miller_set=miller.set(
+            crystal_symmetry=f_sq_obs.crystal_symmetry(),
+            indices=flex_miller_index(hkl_array),
+            anomalous_flag=False,
+        ),
+        data=C_Fs,
+    )
+    # print(miller_set)
+    return miller_set
+
+
+# except Exception as e:
+#     print("something wrong with 'millering'?")
+#     print(e)
+#     pass
+
+
+def reflection_arrays(f_sq_obs):
+    """
+    Returns the indices and data of a miller array as numpy arrays
+    """
+    indices = f_sq_obs.indices().as_vec3_double().as_numpy_array()
+    return indices.astype(np.int32), f_sq_obs.data().as_numpy_array()
+
+
+def phase_reflections(
+    f_sq_obs,
+    cycles,
+    starts=1,
+    seed=None,
+    version="",
+    cache=None,
+    callback=None,
+    daemon_port=0,
+):
+    """
+    Returns the PhAI phase sets for `f_sq_obs`, taken from the PhaseCache
+    `cache` if the same reflections were phased with the same settings
+    before. Runs without a seed are not reproducible and never cached.
+    With a `daemon_port` the phasing is done by the phai_daemon listening
+    there (waiting while it loads the model), falling back to the
+    in-process model if none is listening.
+    """
+    phaser = get_session()
+    if daemon_port:
+        client = DaemonClient(daemon_port, version=version)
+        status = client.ping()
+        if status is None:
+            print(
+                "PhAI: no daemon on port %i, phasing in this process" % daemon_port
+            )
+        elif client.version and status.get("version") != client.version:
+            print(
+                "PhAI: the daemon on port %i serves %s, phasing %s in this process"
+                % (daemon_port, status.get("version"), client.version)
+            )
+        elif status.get("state") == "failed":
+            raise RuntimeError(
+                "the PhAI daemon on port %i could not load the model" % daemon_port
+            )
+        else:
+            if status.get("state") == "loading":
+                # the daemon answers once the model is loaded
+                print("PhAI: waiting for the daemon to load the model")
+            phaser = client
+
+    def cache_key():
+        indices, data = reflection_arrays(f_sq_obs)
+        # phases of a bf16 model differ from the fp32 ones
+        precision = phaser.precision
+        if precision != "fp32":
+            precision_version = "%s/%s" % (version, precision)
+        else:
+            precision_version = version
+        return cache.key(
+            indices,
+            data,
+            f_sq_obs.unit_cell().parameters(),
+            f_sq_obs.space_group_info(),
+            cycles=int(cycles),
+            starts=int(starts),
+            seed=seed,
+            version=precision_version,
+        )
+
+    use_cache = cache is not None and seed is not None
+    if use_cache:
+        sets = cache.get(cache_key())
+        if sets is not None:
+            print("PhAI: phases taken from the cache")
+            return sets
+    sets = phaser.get_phase_sets(
+        f_sq_obs,
+        starts=starts,
+        seed=seed,
+        cycles=int(cycles),
+        name_infile="",
+        INPUT_IS_SQUARED=True,
+        callback=callback,
+    )
+    if use_cache:
+        cache.put(cache_key(), sets)
+    return sets
+
+
+def compute_fft_map(
+    guess, symmetry_flags, fft_grid="fixed", resolution_factor=1.0 / 3
+):
+    """
+    Returns the volume scaled map of `guess`. The "fixed" grid samples
+    every 0.2 A whatever the data; the "adaptive" grid samples at
+    d_min * resolution_factor, with every dimension rounded up to a
+    product of primes <= 5.
+    """
+    if fft_grid != "adaptive":
+        obs_map = guess.fft_map(
+            symmetry_flags=symmetry_flags,
+            resolution_factor=1,
+            grid_step=0.2,
+            f_000=1200,
+        ).apply_volume_scaling()
+        obs_map.apply_volume_scaling()
+        return obs_map
+
+    # a grid coarser than d_min/2 would undersample the map (sampling theorem)
+    resolution_factor = min(float(resolution_factor), 0.5)
+    gridding = guess.crystal_gridding(
+        resolution_factor=resolution_factor,
+        d_min=guess.d_min(),
+        symmetry_flags=symmetry_flags,
+        max_prime=5,
+    )
+    t0 = time.perf_counter()
+    obs_map = guess.fft_map(
+        crystal_gridding=gridding, f_000=1200
+    ).apply_volume_scaling()
+    # scaled twice like the fixed map, so peak heights stay comparable
+    obs_map.apply_volume_scaling()
+    elapsed = time.perf_counter() - t0
+
+    # the fixed grid is not computed, its cost is scaled by N log N
+    n = gridding.n_real()
+    n_fixed = guess.crystal_gridding(
+        resolution_factor=1,
+        grid_step=0.2,
+        symmetry_flags=symmetry_flags,
+        max_prime=5,
+    ).n_real()
+    size = np.prod(n)
+    size_fixed = np.prod(n_fixed)
+    estimate = elapsed * (
+        size_fixed * np.log(size_fixed) / (size * np.log(size)) - 1
+    )
+    print(
+        "PhAI: adaptive FFT grid %s (%.2f A), fixed 0.2 A grid would be %s,"
+        " estimated %.2f s %s (N log N, not measured)"
+        % (
+            "x".join(map(str, n)),
+            guess.d_min() * resolution_factor,
+            "x".join(map(str, n_fixed)),
+            abs(estimate),
+            "faster" if estimate >= 0 else "slower, the adaptive grid is finer",
+        )
+    )
+    return obs_map
+
+
+def _no_report(message):
+    pass
+
+
+def map_peaks(
+    f_sq_obs,
+    phase_set,
+    max_peaks="auto",
+    report=None,
+    trace=None,
+    fft_grid="fixed",
+    resolution_factor=1.0 / 3,
+    use_symmetry=False,
+    peak_engine="cctbx",
+):
+    """
+    Returns the peaks of the map of one (hkl_array, amplitudes_ord, ph)
+    phase set. `fft_grid` and `resolution_factor` go to compute_fft_map.
+
+    By default the phased reflections are expanded to P1 and the whole
+    unit cell is searched; with `use_symmetry` the map is computed from
+    the unique reflections and the peaks are searched in the asymmetric
+    unit only. `peak_engine` "numpy" searches the peaks with
+    phai_peaks.find_peaks instead of cctbx.
+    """
+    if report is None:
+        report = _no_report
+    if trace is None:
+        trace = Trace()
+    hkl_array, amplitudes_ord, ph = phase_set
+    if use_symmetry:
+        with trace.stage("millering"):
+            guess = millering(f_sq_obs, hkl_array, amplitudes_ord, ph)
+        guess = guess.set_observation_type_xray_amplitude()
+    else:
+        with trace.stage("millering"):
+            guess = millering(f_sq_obs, hkl_array, amplitudes_ord, ph)
+        # print(guess)
+        # rename it  fft_map_?
+        with trace.stage("P1 expansion"):
+            guess = guess.expand_to_p1().set_observation_type_xray_amplitude()
+
+    if max_peaks == "auto":
+        expected_peaks = (
+            guess.unit_cell().volume() / 18.6 / len(guess.space_group())
+        )
+        expected_peaks *= 1.3
+        max_peaks = expected_peaks
+    max_peaks = int(max_peaks)
+
+    report("FFT")
+    with trace.stage("FFT"):
+        obs_map = compute_fft_map(
+            guess,
+            sgtbx.search_symmetry_flags(use_space_group_symmetry=use_symmetry),
+            fft_grid,
+            resolution_factor,
+        )
+    # print("obs_map")
+    # print(obs_map)
+    # print(guess.d_min())
+    # print()
+    report("peak search")
+    with trace.stage("peak search"):
+        if peak_engine == "numpy":
+            return find_peaks(
+                obs_map.real_map_unpadded().as_numpy_array(),
+                guess.unit_cell(),
+                guess.space_group(),
+                max_peaks,
+                max(guess.d_min() / 2, 0.2),
+            )
+        peaks = obs_map.peak_search(
+            parameters=maptbx.peak_search_parameters(
+                # peak_search_level=1,
+                # peak_cutoff=0.05,
+                # interpolate=True,
+                min_distance_sym_equiv=0.2,
+                general_positions_only=False,
+                min_cross_distance=guess.d_min() / 2,
+                max_clusters=max_peaks,
+            ),
+            verify_symmetry=True,
+        ).all()
+
+    # print('peaks')
+    # print(list(peaks))
+    # for xyz, height in zip(peaks.sites(), peaks.heights()):
+    #     print(xyz, height)
+    return peaks
+
+
+MAP_OPTIONS = (
+    "fft_grid",
+    "resolution_factor",
+    "use_symmetry",
+    "peak_engine",
+)
+
+
+def compute_solution_peaks(
+    f_sq_obs,
+    cycles=1,
+    max_peaks="auto",
+    report=None,
+    trace=None,
+    **settings
+):
+    """
+    Phases `f_sq_obs` with one random start of PhAI and returns the peaks
+    of its map (several starts are for create_candidate_maps). The Olex2
+    model is not touched, so this can run in a worker thread;
+    `report(message)` is called at every stage and cycle, and the stages
+    are timed in `trace`. The MAP_OPTIONS among `settings` go to
+    map_peaks, the rest to phase_reflections.
+    """
+    if report is None:
+        report = _no_report
+    if trace is None:
+        trace = Trace()
+    map_options = dict((k, settings.pop(k)) for k in MAP_OPTIONS if k in settings)
+
+    def on_cycle(cycle, ph):
+        report("PhAI cycle %i/%i" % (cycle, int(cycles)))
+
+    report("PhAI inference")
+    with trace.stage("inference"):
+        phase_sets = phase_reflections(
+            f_sq_obs, cycles, 1, callback=on_cycle, **settings
+        )
+    return map_peaks(
+        f_sq_obs, phase_sets[0], max_peaks, report, trace, **map_options
+    )
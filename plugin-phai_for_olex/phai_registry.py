@@ -0,0 +1,80 @@
+"""
+Registry of the available PhAI versions.
+
+ai_for_olex.PhAI builds its network from its own weights on every call and
+get_PhAI_phases takes no model, so the only version it can run is the
+built-in DEFAULT_VERSION; weight files of other versions cannot be used
+until the package hands out its model. Every version gets its own
+PhAISession, created when the version is first used and loaded only when it
+phases something. At most `max_models` sessions are kept; the least
+recently used one is unloaded when that number is exceeded.
+"""
+
+import collections
+
+from phai_session import PhAISession
+
+DEFAULT_VERSION = "PhAI_P21_c"
+VERSIONS = (DEFAULT_VERSION,)
+
+
+class ModelRegistry(object):
+    def __init__(self, max_models=2):
+        self.max_models = max(1, int(max_models))
+        self.current = DEFAULT_VERSION
+        self._sessions = collections.OrderedDict()
+
+    def versions(self):
+        return list(VERSIONS)
+
+    def select(self, version):
+        """
+        Makes `version` the current one; nothing is loaded yet
+        """
+        if version not in self.versions():
+            print("PhAI: unknown version %r" % version)
+            return False
+        self.current = version
+        return True
+
+    def session(self, version=None):
+        """
+        Returns the PhAISession of `version` (default: the current one)
+        """
+        version = version or self.current
+        session = self._sessions.get(version)
+        if session is not None:
+            self._sessions.move_to_end(version)
+            return session
+        if version not in self.versions():
+            print("PhAI: unknown version %r, using %s" % (version, DEFAULT_VERSION))
+            return self.session(DEFAULT_VERSION)
+        session = PhAISession()
+        self._sessions[version] = session
+        self.evict()
+        return session
+
+    def evict(self):
+        while len(self._sessions) > self.max_models:
+            version, session = self._sessions.popitem(last=False)
+            if session.unload():
+                print("PhAI: %s evicted" % version)
+
+    def loaded(self):
+        return [v for v, session in self._sessions.items() if session.loaded]
+
+    def unload(self):
+        unloaded = False
+        for session in self._sessions.values():
+            unloaded = session.unload() or unloaded
+        return unloaded
+
+
+_registry = None
+
+
+def get_registry():
+    global _registry
+    if _registry is None:
+        _registry = ModelRegistry()
+    return _registry
@@ -0,0 +1,232 @@
+"""
+Process-wide PhAI model session.
+
+Importing ai_for_olex.PhAI (and with it torch) and building the network is the
+expensive part of a PhAI run. The session does this once and keeps the result
+alive between calls to phai_new.create_solution_map / phai_new.solve, until
+unload() is called explicitly or phai_registry evicts it. get_session()
+returns the session of the version selected in the registry.
+
+The only API of ai_for_olex.PhAI the session relies on is
+get_PhAI_phases(f_sq_obs, t, randomize_phases, cycles, INPUT_IS_SQUARED,
+name_infile), which builds the network and reads its weights on every call.
+The session keeps the module imported and caches what torch.load returns
+during these calls (WeightCache), so the weights are read from disk once.
+A `callback` reporting the cycles is only passed if get_PhAI_phases has the
+keyword (checked with inspect).
+"""
+
+import collections
+import contextlib
+import copy
+import gc
+import inspect
+import os
+import random
+import sys
+import threading
+import time
+
+import numpy as np
+
+PRECISIONS = ("fp32", "bf16")
+
+
+# torch.load is patched process-wide, so only one WeightCache may be active
+# at a time; reentrant, so nested use in one thread restores in order
+_torch_load_lock = threading.RLock()
+
+
+class WeightCache(object):
+    """
+    Keeps the state dicts torch.load returns, while active(), for the weight
+    files of the ai_for_olex.PhAI package, so the weights get_PhAI_phases
+    loads on every call are read and unpickled only once. The patch is
+    process-wide, so any other file and anything that is not a dict is
+    passed through untouched.
+    """
+
+    # state dicts kept at most, the least recently used one is dropped first
+    max_entries = 4
+
+    def __init__(self):
+        self._loaded = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def active(self, directory):
+        torch = sys.modules.get("torch")
+        if torch is None:
+            yield
+            return
+        directory = os.path.join(os.path.abspath(directory), "")
+
+        def load(f, *args, **kwargs):
+            try:
+                path = os.path.abspath(os.fspath(f))
+            except TypeError:
+                # file objects and buffers are not cached
+                return original(f, *args, **kwargs)
+            if not path.startswith(directory):
+                return original(f, *args, **kwargs)
+            try:
+                key = (path, os.path.getmtime(path), repr(args), repr(kwargs))
+            except OSError:
+                return original(f, *args, **kwargs)
+            result = self._loaded.get(key)
+            if result is None:
+                result = original(f, *args, **kwargs)
+                if not isinstance(result, dict):
+                    return result
+                self._loaded[key] = result
+                while len(self._loaded) > self.max_entries:
+                    self._loaded.popitem(last=False)
+            self._loaded.move_to_end(key)
+            # the caller may edit the dict, its tensors are only copied into
+            # the model
+            return copy.copy(result)
+
+        with _torch_load_lock:
+            original = torch.load
+            torch.load = load
+            try:
+                yield
+            finally:
+                torch.load = original
+
+    def clear(self):
+        self._loaded.clear()
+
+
+class PhAISession(object):
+    def __init__(self):
+        self._phai = None
+        self._kwargs = set()
+        self.load_time = None
+        self.calls = 0
+        self.precision = "fp32"
+        self.threads = 0
+        self.interop_threads = 0
+        self._threads_applied = None
+        self._weights = WeightCache()
+
+    @property
+    def loaded(self):
+        return self._phai is not None
+
+    def load(self):
+        if self._phai is not None:
+            return self
+        t0 = time.perf_counter()
+        import ai_for_olex.PhAI as phai
+
+        self._phai = phai
+        self._kwargs = set(inspect.signature(phai.get_PhAI_phases).parameters)
+        self.load_time = time.perf_counter() - t0
+        print("PhAI loaded in %.2f s" % self.load_time)
+        return self
+
+    def configure(self, precision="fp32", threads=0, interop_threads=0):
+        """
+        Sets the CPU inference mode: `precision` is one of PRECISIONS, the
+        thread counts (0 keeps the torch default) are applied on the next
+        call.
+        """
+        if precision not in PRECISIONS:
+            print("PhAI: unknown precision %r, using fp32" % precision)
+            precision = "fp32"
+        self.precision = precision
+        self.threads = int(threads)
+        self.interop_threads = int(interop_threads)
+
+    def _apply_threads(self):
+        threads = (self.threads, self.interop_threads)
+        if threads == self._threads_applied:
+            return
+        import torch
+
+        if self.threads > 0:
+            torch.set_num_threads(self.threads)
+        if self.interop_threads > 0:
+            try:
+                torch.set_num_interop_threads(self.interop_threads)
+            except RuntimeError:
+                # only possible before the first parallel work in the process
+                print("PhAI: inter-op threads can only be set before the first run")
+        self._threads_applied = threads
+
+    def _precision_context(self):
+        if self.precision != "bf16":
+            return contextlib.nullcontext()
+        import torch
+
+        return torch.autocast("cpu", dtype=torch.bfloat16)
+
+    def unload(self):
+        if self._phai is None:
+            return False
+        self._phai = None
+        self._kwargs = set()
+        self._weights.clear()
+        gc.collect()
+        torch = sys.modules.get("torch")
+        if torch is not None and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        print("PhAI model unloaded after %i call(s)" % self.calls)
+        self.calls = 0
+        return True
+
+    def get_phases(self, f_sq_obs, callback=None, **kwargs):
+        """
+        Calls get_PhAI_phases of the resident module. `callback(cycle, ph)`
+        is passed on if the package reports its cycles; an exception raised
+        by it aborts the run.
+        """
+        self.load()
+        if callback is not None and "callback" in self._kwargs:
+            kwargs["callback"] = callback
+        self.calls += 1
+        self._apply_threads()
+        package = os.path.dirname(os.path.abspath(self._phai.__file__))
+        with self._precision_context(), self._weights.active(package):
+            return self._phai.get_PhAI_phases(f_sq_obs, **kwargs)
+
+    def seed(self, seed):
+        """
+        Seeds every random number generator the random phase starts may use
+        """
+        self.load()
+        random.seed(seed)
+        np.random.seed(seed)
+        torch = sys.modules.get("torch")
+        if torch is not None:
+            torch.manual_seed(seed)
+
+    def get_phase_sets(self, f_sq_obs, starts=1, seed=None, **kwargs):
+        """
+        Runs `starts` random phase starts and returns a list of
+        (hkl_array, amplitudes_ord, ph) tuples, one per start. With a `seed`
+        the result is reproducible.
+
+        get_PhAI_phases phases one start per call, so the starts are run one
+        after the other on the warm model.
+        """
+        starts = max(1, int(starts))
+        if seed is not None:
+            self.seed(seed)
+        kwargs["randomize_phases"] = 1
+        return [self.get_phases(f_sq_obs, **kwargs) for i in range(starts)]
+
+
+def get_session():
+    """
+    Returns the session of the current version in the model registry
+    """
+    from phai_registry import get_registry
+
+    return get_registry().session()
+
+
+def unload_session():
+    from phai_registry import get_registry
+
+    return get_registry().unload()
@@ -0,0 +1,101 @@
+"""
+Per-stage instrumentation of a PhAI run.
+
+A Trace records wall time, CPU time and peak RSS for every stage wrapped in
+`with trace.stage(name):`. CPU time is that of the whole process, so threads
+started by torch are included. Peak RSS is the high-water mark of the process
+at the end of the stage, which makes it monotonic over a run.
+"""
+
+import contextlib
+import json
+import sys
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def peak_rss_mb():
+    if resource is not None:
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # bytes on macOS, kilobytes elsewhere
+        return rss / (1024.0 * 1024.0 if sys.platform == "darwin" else 1024.0)
+    if sys.platform == "win32":
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD)] + [
+                (name, ctypes.c_size_t)
+                for name in (
+                    "PeakWorkingSetSize",
+                    "WorkingSetSize",
+                    "QuotaPeakPagedPoolUsage",
+                    "QuotaPagedPoolUsage",
+                    "QuotaPeakNonPagedPoolUsage",
+                    "QuotaNonPagedPoolUsage",
+                    "PagefileUsage",
+                    "PeakPagefileUsage",
+                )
+            ]
+
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        if ctypes.windll.psapi.GetProcessMemoryInfo(
+            ctypes.windll.kernel32.GetCurrentProcess(),
+            ctypes.byref(counters),
+            counters.cb,
+        ):
+            return counters.PeakWorkingSetSize / (1024.0 * 1024.0)
+    return None
+
+
+class Trace(object):
+    def __init__(self, label=""):
+        self.label = label
+        self.started = time.time()
+        self.stages = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            self.stages.append(
+                {
+                    "stage": name,
+                    "wall_s": round(time.perf_counter() - wall, 4),
+                    "cpu_s": round(time.process_time() - cpu, 4),
+                    "peak_rss_mb": peak_rss_mb(),
+                }
+            )
+
+    def as_dict(self):
+        return {
+            "label": self.label,
+            "started": time.strftime(
+                "%Y-%m-%dT%H:%M:%S", time.localtime(self.started)
+            ),
+            "total_wall_s": round(sum(s["wall_s"] for s in self.stages), 4),
+            "stages": self.stages,
+        }
+
+    def summary(self):
+        lines = ["%-20s %9s %9s %12s" % ("stage", "wall/s", "cpu/s", "peak RSS/MB")]
+        for s in self.stages:
+            rss = s["peak_rss_mb"]
+            lines.append(
+                "%-20s %9.3f %9.3f %12s"
+                % (s["stage"], s["wall_s"], s["cpu_s"], "-" if rss is None else "%.0f" % rss)
+            )
+        lines.append("%-20s %9.3f" % ("total", self.as_dict()["total_wall_s"]))
+        return "\n".join(lines)
+
+    def append_jsonl(self, path):
+        with open(path, "a") as f:
+            f.write(json.dumps(self.as_dict()) + "\n")
@@ -0,0 +1,64 @@
+"""
+Background execution of the PhAI phasing stage.
+
+A PhasingJob runs inference, FFT and peak search in a worker thread so the
+Olex2 GUI stays responsive. Olex2 itself is never touched from the worker:
+the main thread polls the job (spy.phai_new.poll_job, scheduled with
+olx.Schedule) to show the progress and to post the peaks once they are ready.
+"""
+
+import threading
+import time
+import traceback
+
+
+class Cancelled(Exception):
+    pass
+
+
+class PhasingJob(threading.Thread):
+    def __init__(self, target, *args, **kwargs):
+        super(PhasingJob, self).__init__(name="PhAI phasing", daemon=True)
+        self._job = (target, args, kwargs)
+        self._cancel = threading.Event()
+        self._lock = threading.Lock()
+        self._progress = "starting"
+        self.t0 = time.perf_counter()
+        self.on_done = None
+        self.result = None
+        self.error = None
+
+    @property
+    def progress(self):
+        with self._lock:
+            return self._progress
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.t0
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def cancel(self):
+        self._cancel.set()
+
+    def report(self, message):
+        """
+        Called by the target at every stage/cycle; raises Cancelled once the
+        job has been cancelled, which stops the target at that point.
+        """
+        if self._cancel.is_set():
+            raise Cancelled()
+        with self._lock:
+            self._progress = message
+
+    def run(self):
+        target, args, kwargs = self._job
+        try:
+            self.result = target(*args, report=self.report, **kwargs)
+        except Cancelled:
+            pass
+        except Exception:
+            self.error = traceback.format_exc()
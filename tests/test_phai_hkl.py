@@ -0,0 +1,106 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), "plugin-phai_for_olex"))
+
+from phai_hkl import parse_hkl
+
+FIXED = (
+    "   1   0   0   10.00    1.00\n"
+    "   2   0   0   20.00    2.00\n"
+    "  -3   1  12  300.50   30.25\n"
+    "   0   0   0    0.00    0.00\n"
+)
+
+
+def write(tmp_path, text, newline="\n"):
+    path = tmp_path / "data.hkl"
+    path.write_bytes(text.replace("\n", newline).encode())
+    return str(path)
+
+
+def check(data):
+    assert data["hkl"].tolist() == [[1, 0, 0], [2, 0, 0], [-3, 1, 12]]
+    assert data["f"].tolist() == [10.0, 20.0, 300.5]
+    assert data["sigma"].tolist() == [1.0, 2.0, 30.25]
+
+
+def test_fixed_width(tmp_path):
+    check(parse_hkl(write(tmp_path, FIXED)))
+
+
+def test_crlf(tmp_path):
+    check(parse_hkl(write(tmp_path, FIXED, "\r\n")))
+
+
+def test_whitespace(tmp_path):
+    text = "1 0 0 10.0 1.0\n2 0 0 20.0 2.0\n-3 1 12 300.5 30.25\n0 0 0 0 0\n"
+    check(parse_hkl(write(tmp_path, text)))
+    check(parse_hkl(write(tmp_path, text, "\r\n")))
+
+
+def test_ragged_raises(tmp_path):
+    text = "1 0 0 10.0 1.0\n2 0 0 20.0\n3 0 0 30.0 3.0 1\n"
+    with pytest.raises(ValueError):
+        parse_hkl(write(tmp_path, text))
+
+
+def test_ignores_lines_after_terminator(tmp_path):
+    text = "1 0 0 10.0 1.0\n2 0 0 20.0 2.0\n-3 1 12 300.5 30.25\n0 0 0 0 0\nCELL 1\n"
+    check(parse_hkl(write(tmp_path, text)))
+
+
+def test_terminator_only(tmp_path):
+    data = parse_hkl(write(tmp_path, "   0   0   0    0.00    0.00\n"))
+    assert len(data) == 0
+    assert isinstance(data, np.ndarray)
+
+
+def test_fixed_width_signs_and_decimals(tmp_path):
+    text = "  -1   2 -13  -12.34    0.56\n   4  -5   6    0.01   -0.10\n"
+    data = parse_hkl(write(tmp_path, text))
+    assert data["hkl"].tolist() == [[-1, 2, -13], [4, -5, 6]]
+    assert data["f"].tolist() == [-12.34, 0.01]
+    assert data["sigma"].tolist() == [0.56, -0.1]
+
+
+def test_moving_decimal_point(tmp_path):
+    text = "   1   0   0  10.000    1.00\n   2   0   0   20.00   2.000\n"
+    data = parse_hkl(write(tmp_path, text))
+    assert data["f"].tolist() == [10.0, 20.0]
+    assert data["sigma"].tolist() == [1.0, 2.0]
+
+
+def test_touching_fields_and_cell_after_terminator(tmp_path):
+    text = (
+        "   1   0   0   10.00    1.00\n"
+        "  -3   1  1012345.67   30.25\n"
+        "   0   0   0    0.00    0.00\n"
+        "CELL 0.71073 10.000 11.000 12.000 90.000 95.000 90.000\n"
+        "ZERR 4 0.001 0.001 0.001 0 0.01 0\n"
+    )
+    data = parse_hkl(write(tmp_path, text))
+    assert data["hkl"].tolist() == [[1, 0, 0], [-3, 1, 10]]
+    assert data["f"].tolist() == [10.0, 12345.67]
+    assert data["sigma"].tolist() == [1.0, 30.25]
+
+
+def test_touching_fields_with_batch_numbers(tmp_path):
+    text = (
+        "   1   2   312345.67  100.00   1\n"
+        "  -1   0   2   20.00    2.00   2\n"
+        "   0   0   0    0.00    0.00   0\n"
+    )
+    data = parse_hkl(write(tmp_path, text))
+    assert data["hkl"].tolist() == [[1, 2, 3], [-1, 0, 2]]
+    assert data["f"].tolist() == [12345.67, 20.0]
+    assert data["sigma"].tolist() == [100.0, 2.0]
+
+
+def test_short_terminator_line(tmp_path):
+    text = FIXED.replace("   0   0   0    0.00    0.00\n", "   0   0   0\n")
+    check(parse_hkl(write(tmp_path, text)))
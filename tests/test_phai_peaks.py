@@ -0,0 +1,138 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), "plugin-phai_for_olex"))
+
+from phai_peaks import find_peaks, interpolate, local_maxima
+
+N = 40
+# fractional sites and heights of the atoms in the asymmetric unit of P-1
+ATOMS = (((0.2, 0.3, 0.41), 3.0), ((0.37, 0.55, 0.12), 2.0))
+
+
+class UnitCell(object):
+    """cubic, a = 10 A"""
+
+    def orthogonalization_matrix(self):
+        return (10, 0, 0, 0, 10, 0, 0, 0, 10)
+
+
+class Matrix(object):
+    def __init__(self, values):
+        self.values = values
+
+    def as_double(self):
+        return self.values
+
+
+class Operation(object):
+    def __init__(self, r, t=(0, 0, 0)):
+        self._r = Matrix(r)
+        self._t = Matrix(t)
+
+    def r(self):
+        return self._r
+
+    def t(self):
+        return self._t
+
+
+class SpaceGroup(object):
+    def __init__(self, *ops):
+        self.ops = ops
+
+    def all_ops(self):
+        return self.ops
+
+
+P1 = SpaceGroup(Operation((1, 0, 0, 0, 1, 0, 0, 0, 1)))
+P_1 = SpaceGroup(
+    Operation((1, 0, 0, 0, 1, 0, 0, 0, 1)),
+    Operation((-1, 0, 0, 0, -1, 0, 0, 0, -1)),
+)
+
+
+def gaussian(site, height, sigma=0.4):
+    """a periodic Gaussian of width `sigma` (A) at `site` on the N**3 grid"""
+    grid = np.indices((N, N, N)).transpose(1, 2, 3, 0) / N
+    diff = grid - np.array(site)
+    diff -= np.rint(diff)
+    return height * np.exp(-((10 * diff) ** 2).sum(axis=-1) / (2 * sigma**2))
+
+
+def inverted(site):
+    return tuple((-x) % 1.0 for x in site)
+
+
+def centrosymmetric_map():
+    data = np.zeros((N, N, N))
+    for site, height in ATOMS:
+        data += gaussian(site, height) + gaussian(inverted(site), height)
+    return data
+
+
+def without_scipy(monkeypatch):
+    # a None entry makes the import raise ImportError
+    monkeypatch.setitem(sys.modules, "scipy", None)
+    monkeypatch.setitem(sys.modules, "scipy.spatial", None)
+
+
+def distance(a, b):
+    diff = np.array(a) - np.array(b)
+    diff -= np.rint(diff)
+    return 10 * np.sqrt((diff**2).sum())
+
+
+def test_local_maxima_periodic():
+    data = gaussian((0.0, 0.5, 0.99), 1.0)
+    # the peak wraps around the cell edge, its maximum is at the grid point 0
+    assert local_maxima(data).tolist() == [[0, 20, 0]]
+
+
+def test_interpolate():
+    site, height = (0.2, 0.3, 0.41), 3.0
+    data = gaussian(site, height)
+    sites, heights = interpolate(data, local_maxima(data))
+    assert len(sites) == 1
+    assert distance(sites[0], site) < 0.02
+    assert heights[0] == pytest.approx(height, rel=0.02)
+
+
+def check_centrosymmetric(peaks):
+    assert len(peaks) == len(ATOMS)
+    for (site, height), found, found_height in zip(
+        ATOMS, peaks.sites(), peaks.heights()
+    ):
+        # either of the two equivalents, but only one of them
+        assert min(distance(found, site), distance(found, inverted(site))) < 0.02
+        assert found_height == pytest.approx(height, rel=0.02)
+
+
+def test_symmetry_equivalents_suppressed():
+    check_centrosymmetric(find_peaks(centrosymmetric_map(), UnitCell(), P_1, 10, 1.0))
+
+
+def test_without_symmetry_all_peaks():
+    peaks = find_peaks(centrosymmetric_map(), UnitCell(), P1, 10, 1.0)
+    assert len(peaks) == 2 * len(ATOMS)
+
+
+def test_max_peaks():
+    peaks = find_peaks(centrosymmetric_map(), UnitCell(), P1, 3, 1.0)
+    assert len(peaks) == 3
+    assert peaks.heights()[0] == pytest.approx(3.0, rel=0.02)
+
+
+def test_fallback_matches_kdtree(monkeypatch):
+    pytest.importorskip("scipy.spatial")
+    data = centrosymmetric_map()
+    tree = find_peaks(data, UnitCell(), P_1, 10, 1.0)
+    without_scipy(monkeypatch)
+    brute_force = find_peaks(data, UnitCell(), P_1, 10, 1.0)
+    assert brute_force.sites() == tree.sites()
+    assert brute_force.heights() == tree.heights()
+    check_centrosymmetric(brute_force)
@@ -0,0 +1,24 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), "plugin-phai_for_olex"))
+
+pytest.importorskip("cctbx")
+
+import phai_pipeline
+
+phai_pipeline.import_cctbx()
+
+
+def test_flex_from_numpy():
+    hkl = np.array([[1, 2, 3], [-4, 5, -6]])
+    indices = phai_pipeline.flex_miller_index(hkl)
+    data = phai_pipeline.flex_double(np.array([1.5, -2.0]))
+    assert list(indices) == [(1, 2, 3), (-4, 5, -6)]
+    assert list(data) == [1.5, -2.0]
+    # both conversions took the numpy buffer path
+    assert not phai_pipeline.flex_without_numpy
@@ -0,0 +1,105 @@
+import io
+import json
+import os
+import sys
+import tarfile
+
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from workflow_git_sync_plugin_and_module import (
+    BUNDLE_MANIFEST,
+    SyncError,
+    apply_bundle,
+    build_bundle,
+)
+
+CONFIG = {"plugin_phai_for_olex": {"data_plugin": {"dir": "plugin"}}}
+
+
+def write_files(directory, files):
+    for name, text in files.items():
+        path = directory / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(text)
+
+
+def read_files(directory):
+    return dict(
+        (str(path.relative_to(directory)).replace(os.sep, "/"), path.read_text())
+        for path in directory.rglob("*")
+        if path.is_file() and path.name != ".bundle_manifest.json"
+    )
+
+
+@pytest.fixture
+def dirs(tmp_path):
+    source, install = tmp_path / "source", tmp_path / "install"
+    (source / "plugin").mkdir(parents=True)
+    (install / "plugin").mkdir(parents=True)
+    return source, install, str(tmp_path / "bundle.tar.gz")
+
+
+def sync(source, install, bundle):
+    build_bundle(CONFIG, str(source), bundle)
+    apply_bundle(CONFIG, str(install), bundle)
+
+
+def test_build_and_apply(dirs):
+    source, install, bundle = dirs
+    files = {"phai.py": "print(1)\n", "sub/model.txt": "weights\n"}
+    write_files(source / "plugin", files)
+    (source / "plugin" / "__pycache__").mkdir()
+    (source / "plugin" / "__pycache__" / "phai.pyc").write_bytes(b"\0")
+    sync(source, install, bundle)
+    assert read_files(install / "plugin") == files
+
+
+def test_reapply_leaves_unchanged_files(dirs):
+    source, install, bundle = dirs
+    write_files(source / "plugin", {"same.py": "same\n", "edited.py": "old\n"})
+    sync(source, install, bundle)
+    for name in ("same.py", "edited.py"):
+        os.utime(install / "plugin" / name, (1, 1))
+    write_files(source / "plugin", {"edited.py": "new\n"})
+    sync(source, install, bundle)
+    assert os.stat(install / "plugin" / "same.py").st_mtime == 1
+    assert os.stat(install / "plugin" / "edited.py").st_mtime != 1
+    assert (install / "plugin" / "edited.py").read_text() == "new\n"
+
+
+def test_dropped_files_removed_unless_modified(dirs):
+    source, install, bundle = dirs
+    write_files(
+        source / "plugin",
+        {"keep.py": "keep\n", "dropped.py": "gone\n", "edited.py": "bundled\n"},
+    )
+    sync(source, install, bundle)
+    (install / "plugin" / "edited.py").write_text("local change\n")
+    (install / "plugin" / "local.py").write_text("never bundled\n")
+    os.remove(source / "plugin" / "dropped.py")
+    os.remove(source / "plugin" / "edited.py")
+    sync(source, install, bundle)
+    assert read_files(install / "plugin") == {
+        "keep.py": "keep\n",
+        "edited.py": "local change\n",
+        "local.py": "never bundled\n",
+    }
+
+
+def test_unsafe_path_raises(dirs):
+    source, install, bundle = dirs
+    manifest = {"entries": {"data_plugin": {"../evil.py": "0" * 64}}}
+    with tarfile.open(bundle, "w:gz") as tar:
+        for name, data in (
+            (BUNDLE_MANIFEST, json.dumps(manifest).encode()),
+            ("data_plugin/../evil.py", b"evil\n"),
+        ):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    with pytest.raises(SyncError):
+        apply_bundle(CONFIG, str(install), bundle)
+    assert not (install / "evil.py").exists()
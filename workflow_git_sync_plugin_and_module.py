@@ -1,24 +1,80 @@
+import argparse
+import concurrent.futures
+import hashlib
+import io
 import os
 import shutil
 import subprocess
 import sys
 import json
+import tarfile
+import threading
+import time
+
+# keeps the output of repositories synced in parallel from interleaving
+print_lock = threading.Lock()
+
+
+class SyncError(Exception):
+    pass
+
+
+def log(message, file=None):
+    with print_lock:
+        print(message, file=file or sys.stdout)
 
 
 def run_command(command, working_dir="."):
-    """Runs a command in a specified directory and checks for errors."""
-    print(f"\n>> RUNNING: '{command}' in '{working_dir}'")
+    """
+    Runs a command (a list of arguments) in a specified directory and
+    returns its output. Raises SyncError if it fails.
+    """
     try:
-        subprocess.run(command, shell=True, check=True, text=True, cwd=working_dir)
+        result = subprocess.run(
+            command, check=True, text=True, cwd=working_dir, capture_output=True
+        )
     except subprocess.CalledProcessError as e:
-        print(f"Error executing command: {e}", file=sys.stderr)
-        sys.exit(1)
-    except FileNotFoundError:
-        print(
-            f"Command not found. Make sure Git is installed and in your PATH.",
+        log(
+            f"\n>> RUNNING: '{' '.join(command)}' in '{working_dir}'\n{e.stdout}{e.stderr}",
             file=sys.stderr,
         )
-        sys.exit(1)
+        raise SyncError(f"Error executing command: {e}")
+    except FileNotFoundError:
+        raise SyncError(
+            "Command not found. Make sure Git is installed and in your PATH."
+        )
+    log(
+        f"\n>> RUNNING: '{' '.join(command)}' in '{working_dir}'\n{result.stdout}{result.stderr}".rstrip()
+    )
+    return result.stdout
+
+
+def fetch_options(repo_config):
+    """
+    The shallow/partial clone options of a config entry: "depth" (number
+    of commits) and "filter" (e.g. "blob:none")
+    """
+    options = []
+    if repo_config.get("depth"):
+        options.append(f"--depth={int(repo_config['depth'])}")
+    if repo_config.get("filter"):
+        options.append(f"--filter={repo_config['filter']}")
+    return options
+
+
+def is_up_to_date(target_dir, branch):
+    """
+    True if the checked out commit is the head of `branch` on the remote,
+    asked with ls-remote so nothing is fetched
+    """
+    try:
+        remote = run_command(
+            ["git", "ls-remote", "origin", f"refs/heads/{branch}"], target_dir
+        ).split()
+        local = run_command(["git", "rev-parse", "HEAD"], target_dir).strip()
+    except SyncError:
+        return False
+    return bool(remote) and remote[0] == local
 
 
 def process_repository(repo_config, target_dir):
@@ -28,32 +84,48 @@ def process_repository(repo_config, target_dir):
     git_url = repo_config.get("git_url")
     branch = repo_config.get("branch", "main")
     is_sparse = repo_config.get("sparse", False)
+    depth = repo_config.get("depth")
+    partial_filter = repo_config.get("filter")
     cwd = os.getcwd()
 
     if not git_url:
-        print(f"Skipping entry, missing 'git_url': {repo_config}")
+        log(f"Skipping entry, missing 'git_url': {repo_config}")
         return
 
     # --- 1. If it's already a Git repo, just pull updates ---
     if os.path.exists(os.path.join(target_dir, ".git")):
-        print(
+        if is_up_to_date(target_dir, branch):
+            log(f"--- '{target_dir}' is already at the remote head of {branch} ---")
+            return
+        log(
             f"--- Directory exists as a Git repo. Attempting to pull updates in '{target_dir}' ---"
         )
         try:
-            run_command(f"git pull origin {branch}", working_dir=target_dir)
-        except subprocess.CalledProcessError:
-            print(
+            if depth:
+                # a shallow history cannot be fast-forwarded by pull; --keep
+                # still refuses to overwrite local changes
+                run_command(
+                    ["git", "fetch", f"--depth={int(depth)}", "origin", branch],
+                    working_dir=target_dir,
+                )
+                run_command(
+                    ["git", "reset", "--keep", "FETCH_HEAD"], working_dir=target_dir
+                )
+            else:
+                run_command(["git", "pull", "origin", branch], working_dir=target_dir)
+        except SyncError:
+            log(
                 f"Warning: Could not pull updates for '{target_dir}'. There might be local changes.",
                 file=sys.stderr,
             )
 
     # --- 2. If it's not a Git repo, perform the initial setup ---
     else:
-        print(f"--- Setting up new repository in '{target_dir}' ---")
+        log(f"--- Setting up new repository in '{target_dir}' ---")
 
         # Conditional Cleanup: Only delete the directory if it's NOT the one we're currently in.
         if os.path.exists(target_dir) and not os.path.samefile(target_dir, cwd):
-            print(f">> Deleting existing non-repo directory: {target_dir}")
+            log(f">> Deleting existing non-repo directory: {target_dir}")
             shutil.rmtree(target_dir)
 
         # Ensure the directory exists (this is safe to run even if it's the CWD)
@@ -61,43 +133,189 @@ def process_repository(repo_config, target_dir):
 
         if is_sparse:
             # The sparse checkout flow (init, remote, pull) is safe for an existing, non-empty directory.
-            print(f"--- Performing SPARSE CHECKOUT for {target_dir} ---")
+            log(f"--- Performing SPARSE CHECKOUT for {target_dir} ---")
             checkout_dirs = repo_config.get("directories_checkout", [])
-            run_command(f"git init -b {branch}", working_dir=target_dir)
-            run_command(f"git remote add origin {git_url}", working_dir=target_dir)
-            run_command("git config core.sparseCheckout true", working_dir=target_dir)
+            run_command(["git", "init", "-b", branch], working_dir=target_dir)
+            run_command(
+                ["git", "remote", "add", "origin", git_url], working_dir=target_dir
+            )
+            run_command(
+                ["git", "config", "core.sparseCheckout", "true"],
+                working_dir=target_dir,
+            )
+            if partial_filter:
+                # later fetches of this remote use the same filter
+                run_command(
+                    ["git", "config", "remote.origin.promisor", "true"],
+                    working_dir=target_dir,
+                )
+                run_command(
+                    ["git", "config", "remote.origin.partialclonefilter", partial_filter],
+                    working_dir=target_dir,
+                )
             sparse_checkout_file = os.path.join(
                 target_dir, ".git", "info", "sparse-checkout"
             )
             with open(sparse_checkout_file, "w") as f:
                 for directory in checkout_dirs:
                     f.write(f"{directory}\n")
-            run_command(f"git pull origin {branch}", working_dir=target_dir)
+            depth_option = [f"--depth={int(depth)}"] if depth else []
+            run_command(
+                ["git", "pull"] + depth_option + ["origin", branch],
+                working_dir=target_dir,
+            )
         else:
             # A full clone requires the target directory to be empty.
-            print(f"--- Performing FULL CLONE for {target_dir} ---")
+            log(f"--- Performing FULL CLONE for {target_dir} ---")
             if len(os.listdir(target_dir)) > 0:
-                print(
-                    f"Error: Cannot perform a full clone into '{os.path.basename(target_dir)}' because it is not empty.",
-                    file=sys.stderr,
-                )
-                print(
+                log(
+                    f"Error: Cannot perform a full clone into '{os.path.basename(target_dir)}' because it is not empty.\n"
                     "Please run the script from an empty folder or the parent directory.",
                     file=sys.stderr,
                 )
                 return  # Stop processing this repository
 
             run_command(
-                f"git clone --branch {branch} {git_url} .", working_dir=target_dir
+                ["git", "clone", "--branch", branch]
+                + fetch_options(repo_config)
+                + [git_url, "."],
+                working_dir=target_dir,
+            )
+
+    log(f"--- Successfully processed '{os.path.basename(target_dir)}' ---")
+
+
+BUNDLE_MANIFEST = "manifest.json"
+# the manifest of the last bundle applied to a directory
+APPLIED_MANIFEST = ".bundle_manifest.json"
+SKIP_DIRS = (".git", "__pycache__")
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def bundle_sources(config_data, cwd):
+    """
+    The directories that go into a bundle: {name: directory}, the synced
+    repositories plus the "bundle_extra" entries (e.g. model weights)
+    """
+    sources = {}
+    for key, config in config_data["plugin_phai_for_olex"].items():
+        if isinstance(config, dict) and "dir" in config:
+            sources[key] = config["dir"]
+    for key, config in config_data.get("bundle_extra", {}).items():
+        sources[key] = config["dir"]
+    return dict((key, os.path.join(cwd, d)) for key, d in sources.items())
+
+
+def list_files(directory):
+    """
+    Returns {relative path: sha256} of the files below `directory`
+    """
+    files = {}
+    for root, dirs, names in os.walk(directory):
+        dirs[:] = sorted(d for d in dirs if d not in SKIP_DIRS)
+        for name in sorted(names):
+            if name == APPLIED_MANIFEST:
+                continue
+            path = os.path.join(root, name)
+            files[os.path.relpath(path, directory).replace(os.sep, "/")] = file_sha256(path)
+    return files
+
+
+def build_bundle(config_data, cwd, bundle_path):
+    """
+    Writes the configured directories (without .git) and a manifest of
+    their content hashes to the compressed tar file `bundle_path`
+    """
+    manifest = {"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "entries": {}}
+    with tarfile.open(bundle_path, "w:gz") as tar:
+        for key, directory in bundle_sources(config_data, cwd).items():
+            if not os.path.isdir(directory):
+                print(f"Warning: '{directory}' not found, not bundled", file=sys.stderr)
+                continue
+            files = list_files(directory)
+            manifest["entries"][key] = files
+            for name in files:
+                tar.add(os.path.join(directory, name), arcname=f"{key}/{name}")
+            print(f"--- Bundled {len(files)} files of '{directory}' as '{key}' ---")
+        data = json.dumps(manifest, indent=1).encode()
+        info = tarfile.TarInfo(BUNDLE_MANIFEST)
+        info.size = len(data)
+        info.mtime = time.time()
+        tar.addfile(info, io.BytesIO(data))
+    print(f"--- Bundle written to '{bundle_path}' ---")
+
+
+def apply_bundle(config_data, cwd, bundle_path):
+    """
+    Updates the configured directories from a bundle: only files whose
+    hash differs from the local copy are extracted, and files dropped
+    since the previously applied bundle are removed
+    """
+    targets = bundle_sources(config_data, cwd)
+    with tarfile.open(bundle_path, "r:*") as tar:
+        manifest = json.load(tar.extractfile(BUNDLE_MANIFEST))
+        for key, files in manifest["entries"].items():
+            if key not in targets:
+                print(f"Warning: '{key}' is not configured, skipped", file=sys.stderr)
+                continue
+            directory = targets[key]
+            applied_path = os.path.join(directory, APPLIED_MANIFEST)
+            applied = {}
+            if os.path.exists(applied_path):
+                with open(applied_path) as f:
+                    applied = json.load(f)
+            updated = 0
+            for name, digest in files.items():
+                path = os.path.normpath(os.path.join(directory, name))
+                if os.path.isabs(name) or not path.startswith(os.path.normpath(directory) + os.sep):
+                    raise SyncError(f"Unsafe path '{name}' in the bundle")
+                if os.path.exists(path) and file_sha256(path) == digest:
+                    continue
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                source = tar.extractfile(f"{key}/{name}")
+                with open(path + ".tmp", "wb") as f:
+                    shutil.copyfileobj(source, f)
+                os.replace(path + ".tmp", path)
+                updated += 1
+            removed = 0
+            for name in set(applied) - set(files):
+                path = os.path.join(directory, name)
+                if os.path.exists(path) and file_sha256(path) == applied[name]:
+                    os.remove(path)
+                    removed += 1
+            with open(applied_path, "w") as f:
+                json.dump(files, f, indent=1)
+            print(
+                f"--- '{directory}': {updated} files updated, {removed} removed, "
+                f"{len(files) - updated} unchanged ---"
             )
 
-    print(f"--- Successfully processed '{os.path.basename(target_dir)}' ---")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Sync the PhAI plugin and module from git, or from an offline bundle."
+    )
+    parser.add_argument(
+        "--build-bundle", metavar="FILE", help="write the synced directories to a bundle"
+    )
+    parser.add_argument(
+        "--apply-bundle", metavar="FILE", help="update the directories from a bundle"
+    )
+    return parser.parse_args(argv)
 
 
 def main():
     """
     Main function to check context and dispatch repository processing.
     """
+    args = parse_args()
     config_file = "config_plugins_ai_for_olex.json"
     if not os.path.exists(config_file):
         print(f"Error: Configuration file '{config_file}' not found.", file=sys.stderr)
@@ -114,6 +332,25 @@ def main():
 
     config_plugin = config_data['plugin_phai_for_olex']
 
+    # Offline bundles cover all repositories, from the container directory
+    if args.build_bundle or args.apply_bundle:
+        if not (must_be_in and current_dir_name == must_be_in[-1]):
+            print(
+                f"Bundles are built and applied from the main container directory ('{must_be_in[-1] if must_be_in else ''}').",
+                file=sys.stderr,
+            )
+            sys.exit(1)
+        try:
+            if args.build_bundle:
+                build_bundle(config_data, cwd, args.build_bundle)
+            else:
+                apply_bundle(config_data, cwd, args.apply_bundle)
+        except (OSError, KeyError, SyncError, tarfile.TarError) as e:
+            print(f"Error: {e}", file=sys.stderr)
+            sys.exit(1)
+        print("\nScript finished successfully.")
+        return
+
     # Scenario A: Check if we are inside a specific plugin directory
     target_repo_config = None
     for key, config in config_plugin.items():
@@ -124,17 +361,37 @@ def main():
     if target_repo_config:
         # We are inside a specific plugin dir, so sync in-place.
         print(f"== Mode: Sync-in-place for '{current_dir_name}' ==")
-        process_repository(target_repo_config, cwd)  # Target is the current directory
+        try:
+            process_repository(target_repo_config, cwd)  # Target is the current directory
+        except SyncError as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
 
     # Scenario B: Check if we are in the parent container directory
     elif must_be_in and current_dir_name == must_be_in[-1]:
         # We are in the main container, so sync all configured repos.
         print(f"== Mode: Batch Sync in '{current_dir_name}' ==")
-        for key, config in config_plugin.items():
-            if isinstance(config, dict) and "dir" in config:
-                # Target is a new subdirectory for each plugin
-                target_dir = os.path.join(cwd, config["dir"])
-                process_repository(config, target_dir)
+        # Target is a new subdirectory for each plugin
+        targets = [
+            (config, os.path.join(cwd, config["dir"]))
+            for config in config_plugin.values()
+            if isinstance(config, dict) and "dir" in config
+        ]
+        max_workers = config_data.get("max_workers") or len(targets) or 1
+        failed = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+            jobs = dict(
+                (pool.submit(process_repository, config, target_dir), target_dir)
+                for config, target_dir in targets
+            )
+            for job in concurrent.futures.as_completed(jobs):
+                try:
+                    job.result()
+                except SyncError as e:
+                    log(f"Error syncing '{jobs[job]}': {e}", file=sys.stderr)
+                    failed.append(jobs[job])
+        if failed:
+            sys.exit(1)
     else:
         # Invalid Location
         print(